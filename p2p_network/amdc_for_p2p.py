@@ -4,10 +4,13 @@ For more see: "Supplemental Information: Experimental implementation of secure a
 quantum network" - Huang, Joshi 2002
 """
 
+import math
 import numpy as np
 import yaml
-from secrets import randbits
-import galois
+from functools import lru_cache
+from pathlib import Path
+from numba import njit
+from secrets import token_bytes
 
 
 def debug_print(message, debug: bool) -> None:
@@ -15,6 +18,153 @@ def debug_print(message, debug: bool) -> None:
         print(f"      {message}")
 
 
+def _debug_print_polys(b_poly: int, theta_poly: int, u_poly_list: np.ndarray) -> None:
+    """
+    Prints the polynomials used by encoding and decoding, only called in debug mode
+    :param b_poly: irreducible polynomial b(x)
+    :param theta_poly: polynomial theta(x)
+    :param u_poly_list: polynomials u_1 ... u_d
+    """
+    debug_print(f"Get b from dict: {b_poly:b}", True)
+    debug_print("Creating polynomials", True)
+    debug_print(f"theta_poly = {theta_poly:b}", True)
+    debug_print(f"u_poly_list = {u_poly_list}", True)
+    for i, u in enumerate(u_poly_list):
+        debug_print(f"   u{i} = {u:b}", True)
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    """
+    Packs an array of 0's and 1's into an int, first bit is the most significant one
+    :param bits: uint8 array of 0's and 1's
+    :return: int whose binary representation is *bits*
+    """
+    return int.from_bytes(np.packbits(bits).tobytes(), "big") >> (-len(bits) % 8)
+
+
+def _int_to_bits(x: int, width: int) -> np.ndarray:
+    """
+    Unpacks an int into an array of 0's and 1's, first bit is the most significant one
+    :param x: int to unpack
+    :param width: length of the resulting array, filled with leading 0's
+    :return: array of 0's and 1's
+    """
+    return np.unpackbits(np.frombuffer(x.to_bytes((width + 7) // 8, "big"), dtype=np.uint8))[-width:]
+
+
+def _split_into_polys(padded_message, d: int, gamma: int) -> np.ndarray:
+    """
+    Packs the padded message into one int and splits it into d polynomials u_1 ... u_d of gamma bits each
+    :param padded_message: message of length d * gamma as uint8 array of 0's and 1's
+    :param d: d parameter
+    :param gamma: gamma parameter
+    :return: uint64 array of the d polynomials
+    """
+    message_poly = _bits_to_int(padded_message)
+    mask = (1 << gamma) - 1
+    return np.array([(message_poly >> ((d - i) * gamma)) & mask for i in range(1, d + 1)], dtype=np.uint64)
+
+
+@njit(cache=True)
+def _clmul_u64(a: np.uint64, b: np.uint64) -> np.uint64:
+    """
+    Carry-less multiplication of two binary polynomials of at most 32 bits, which are represented as uint64
+    :param a: polynomial a(x)
+    :param b: polynomial b(x)
+    :return: a(x) * b(x) over GF(2)
+    """
+    result = np.uint64(0)
+    while b:
+        if b & np.uint64(1):
+            result ^= a
+        a <<= np.uint64(1)
+        b >>= np.uint64(1)
+    return result
+
+
+@njit(cache=True)
+def _clmod_u64(a: np.uint64, b: np.uint64, mu: np.uint64, gamma: int) -> np.uint64:
+    """
+    Barrett reduction of a product of two polynomials of at most gamma bits by b(x) of degree gamma.
+    The quotient is estimated as ((a >> gamma) * mu) >> gamma, which is exact for polynomials over GF(2)
+    :param a: dividend a(x) of at most 2 * gamma - 1 bits
+    :param b: divisor b(x) of degree gamma
+    :param mu: Barrett constant x^(2 * gamma) // b(x)
+    :param gamma: gamma parameter
+    :return: a(x) mod b(x) over GF(2)
+    """
+    quotient = _clmul_u64(a >> np.uint64(gamma), mu) >> np.uint64(gamma)
+    return a ^ _clmul_u64(quotient, b)
+
+
+@njit(cache=True)
+def _calculate_f_mod_b(theta_poly: np.uint64, u_polys: np.ndarray, b_poly: np.uint64, mu: np.uint64,
+                       gamma: int) -> np.uint64:
+    """
+    Calculates f(x) mod b(x) with f(x) = theta^(d+2) + u_d * theta^d + ... + u_1 * theta in Horner form
+    f(x) = (...((theta^2 + u_d) * theta + u_(d-1)) * theta + ... + u_1) * theta
+    Every intermediate product is reduced mod b(x), so it never grows beyond 2 * gamma bits and fits into uint64
+    :param theta_poly: polynomial theta(x)
+    :param u_polys: polynomials u_1 ... u_d as uint64 array
+    :param b_poly: irreducible polynomial b(x)
+    :param mu: Barrett constant x^(2 * gamma) // b(x)
+    :param gamma: gamma parameter, at most 32
+    :return: f(x) mod b(x) over GF(2)
+    """
+    f_poly = _clmod_u64(_clmul_u64(theta_poly, theta_poly), b_poly, mu, gamma)
+    for i in range(len(u_polys) - 1, -1, -1):
+        f_poly = _clmod_u64(_clmul_u64(f_poly ^ u_polys[i], theta_poly), b_poly, mu, gamma)
+    return f_poly
+
+
+def _clmul_lanes(a: np.ndarray, b: np.ndarray, gamma: int) -> np.ndarray:
+    """
+    Carry-less multiplication of many binary polynomials of at most gamma bits at once, one polynomial per uint64 lane
+    :param a: polynomials a_j(x) as uint64 array
+    :param b: polynomials b_j(x) as uint64 array
+    :param gamma: maximum bit length of the polynomials, at most 32 so the products fit into uint64
+    :return: a_j(x) * b_j(x) over GF(2) as uint64 array
+    """
+    result = np.zeros_like(a)
+    for k in range(gamma):
+        result ^= (a << np.uint64(k)) * ((b >> np.uint64(k)) & np.uint64(1))
+    return result
+
+
+def _clmod_lanes(a: np.ndarray, b: int, gamma: int) -> np.ndarray:
+    """
+    Reduces many products of two polynomials of at most gamma bits mod b(x) at once, one polynomial per uint64 lane
+    :param a: polynomials a_j(x) of at most 2 * gamma - 1 bits as uint64 array
+    :param b: irreducible polynomial b(x) of degree gamma
+    :param gamma: gamma parameter
+    :return: a_j(x) mod b(x) over GF(2) as uint64 array
+    """
+    for k in range(2 * gamma - 2, gamma - 1, -1):
+        a ^= ((a >> np.uint64(k)) & np.uint64(1)) * np.uint64(b << (k - gamma))
+    return a
+
+
+@lru_cache(maxsize=None)
+def _solve_d_and_gamma(beta: int, m_len: int) -> tuple[int, int]:
+    """
+    Finds the smallest odd d with d * (beta + log2(d + 1)) >= m_len and the corresponding gamma
+    :param beta: security parameter
+    :param m_len: length of message
+    :return: d and gamma as tuple
+    """
+    # Start next to the solution of d * (beta + log2(d + 1)) = m_len, the left side grows with d, so only a few
+    # steps of 2 are needed to reach the smallest odd d
+    d_estimate = m_len / max(beta + 1, 1)
+    d_estimate = m_len / max(beta + math.log2(d_estimate + 1), 1)
+    d = max(1, int(d_estimate) | 1)
+    while d > 1 and (d - 2) * (beta + math.log2(d - 1)) >= m_len:
+        d -= 2
+    while d * (beta + math.log2(d + 1)) < m_len:
+        d += 2
+    gamma = math.ceil(beta + math.log2(d + 1))
+    return d, gamma
+
+
 def find_d_and_gamma(beta: int, m_len: int, debug: bool) -> tuple[int, int]:
     """
     Finds d and gamma parameter based on beta and message length
@@ -23,151 +173,214 @@ def find_d_and_gamma(beta: int, m_len: int, debug: bool) -> tuple[int, int]:
     :param m_len: length of message
     :return: d and gamma as tuple
     """
-    d = 1
-    while d * (beta + np.log2(d + 1)) < m_len:
-        debug_print(f"Finding d: Trying d = {d}: result: {d * (beta + np.log2(d + 1)):.2f} - m_len = {m_len}",
-                    debug)
-        d += 2
-    debug_print(f"Found d = {d}: result: {d * (beta + np.log2(d + 1)):.2f} - m_len = {m_len}", debug)
-    gamma = int(np.ceil(beta + np.log2(d + 1)))
+    d, gamma = _solve_d_and_gamma(beta, m_len)
+    if debug:
+        debug_print(f"Found d = {d}: result: {d * (beta + math.log2(d + 1)):.2f} - m_len = {m_len}", debug)
     return d, gamma
 
 
+@lru_cache(maxsize=None)
+def _load_binary_irreducible_dict() -> dict:
+    """
+    Loads the dict of binary irreducible polynomials from the .yaml file, the file is only read once
+    :return: dict with gamma as key and the polynomial as string of 0's and 1's as value
+    """
+    with open(Path(__file__).with_name("binary_irreducible_polynomials_dict.yaml"), "r") as handle:
+        return yaml.safe_load(handle)
+
+
 def get_binary_irreducible(gamma: int) -> str:
     """
     Gets irreducible binary polynomial of degree *gamma* from the .yaml file
     :param gamma: gamma parameter
     :return: String of 0's and 1's which represent a binary irreducible polynomial of degree gamma
     """
-    with open("binary_irreducible_polynomials_dict.yaml", "r") as handle:
-        irreducible_binary_polynomial_dict = yaml.safe_load(handle)
-    return irreducible_binary_polynomial_dict.get(gamma)
+    return _load_binary_irreducible_dict().get(gamma)
 
 
-def amdc_encode_message(message: list, beta: int, debug: bool) -> list[int]:
+@lru_cache(maxsize=None)
+def _get_binary_irreducible_poly(gamma: int) -> int:
+    """
+    Gets irreducible binary polynomial of degree *gamma* packed into an int
+    :param gamma: gamma parameter
+    :return: int whose binary representation is the irreducible polynomial of degree gamma
+    """
+    return int(str(get_binary_irreducible(gamma)), 2)
+
+
+@lru_cache(maxsize=None)
+def _get_barrett_constant(gamma: int) -> int:
+    """
+    Calculates the Barrett constant mu = x^(2 * gamma) // b(x) for the irreducible polynomial of degree *gamma*
+    :param gamma: gamma parameter
+    :return: mu packed into an int
+    """
+    b_poly = _get_binary_irreducible_poly(gamma)
+    remainder = 1 << (2 * gamma)
+    mu = 0
+    while remainder.bit_length() > gamma:
+        shift = remainder.bit_length() - gamma - 1
+        mu |= 1 << shift
+        remainder ^= b_poly << shift
+    return mu
+
+
+def amdc_encode_message(message, beta: int, debug: bool) -> np.ndarray:
     """
     Encodes a message with an AMDC
-    :param message: message as a field of 0's and 1's
+    :param message: message as a field of 0's and 1's, list or uint8 array
     :param beta: probability that error is detected is 1-2**-beta
     :param debug: if True prints out calculation steps
-    :return: encoded message as list of 0's and 1's
+    :return: encoded message as uint8 array of 0's and 1's
     """
     debug_print("----------Encoding with AMDC----------", debug)
     d, gamma = find_d_and_gamma(beta, len(message), debug)
-    debug_print(f"d = {d}, gamma = {gamma}", debug)
+    if debug:
+        debug_print(f"d = {d}, gamma = {gamma}", debug)
 
-    theta_binary = [randbits(1) for _ in range(gamma)]
-    debug_print("Creating random theta binary string", debug)
-    debug_print(f"theta_binary = {theta_binary} - len: {len(theta_binary)}", debug)
+    # Draw all random bits of theta at once and cut them to gamma bits
+    theta_bytes = token_bytes((gamma + 7) // 8)
+    theta_binary = np.unpackbits(np.frombuffer(theta_bytes, dtype=np.uint8))[:gamma]
+    if debug:
+        debug_print("Creating random theta binary string", debug)
+        debug_print(f"theta_binary = {theta_binary} - len: {len(theta_binary)}", debug)
 
-    debug_print(f"message: {message}", debug)
     # Fill message with 0 till length is d * gamma
-    debug_print(f"0's appended: {d * gamma - len(message)}", debug)
-    padded_message = message + [0] * (d * gamma - len(message))
-    debug_print(f"Padded message: m = {padded_message} - len: {len(padded_message)}", debug)
+    padded_message = np.pad(np.asarray(message, dtype=np.uint8), (0, d * gamma - len(message)))
+    if debug:
+        debug_print(f"message: {message}", debug)
+        debug_print(f"0's appended: {d * gamma - len(message)}", debug)
+        debug_print(f"Padded message: m = {padded_message} - len: {len(padded_message)}", debug)
 
     # Get irreducible polynomial from list
-    b = get_binary_irreducible(gamma)
-    debug_print(f"Get b from dict: {b}", debug)
-    b_binary = [int(d) for d in str(b)]
-
-    # Create polynomials
-    debug_print("Creating polynomials", debug)
-    gf = galois.GF(2)
-    b_poly = galois.Poly(b_binary, gf)
-    debug_print(f"b_poly = {b_poly}", debug)
-    theta_poly = galois.Poly(theta_binary, gf)
-    debug_print(f"theta_poly = {theta_poly}", debug)
-    u_poly_list = [galois.Poly(u, gf) for u in np.array_split(padded_message, d)]
-    debug_print(f"u_poly_list = {u_poly_list}", debug)
-    for u in u_poly_list:
-        debug_print(f"   u{u_poly_list.index(u)} = {u}", debug)
-
-    # Calculate f(x)
-    debug_print(f"Calculating f(x)", debug)
-    f_poly = theta_poly ** (d + 2)
-    for i in range(1, d + 1):
-        f_poly += u_poly_list[i - 1] * (theta_poly ** i)
-
-    debug_print(f"   f(x) = \n{f_poly}", debug)
-
-    # Divide f(x)/b(x)
-    quotient_poly = f_poly // b_poly
-    remainder_poly = f_poly % b_poly
-    debug_print("Calculate f(x)/b(x)", debug)
-    debug_print(f"quotient = {quotient_poly}\nremainder = {remainder_poly}", debug)
-
-    # cast np array to int_list, do modulo 2 and fill it with leading 0
-    tau_binary = list(map(int, bin(remainder_poly)[2:]))
-    tau_binary = [0] * (gamma - len(tau_binary)) + tau_binary
-    debug_print(f"tau: {tau_binary} - len: {len(tau_binary)}", debug)
+    b_poly = _get_binary_irreducible_poly(gamma)
+
+    # Create polynomials, bit i of an int is the coefficient of x^i
+    theta_poly = int.from_bytes(theta_bytes, "big") >> (8 * len(theta_bytes) - gamma)
+    u_poly_list = _split_into_polys(padded_message, d, gamma)
+    if debug:
+        _debug_print_polys(b_poly, theta_poly, u_poly_list)
+
+    # Calculate f(x) mod b(x)
+    mu = _get_barrett_constant(gamma)
+    remainder_poly = int(_calculate_f_mod_b(np.uint64(theta_poly), u_poly_list, np.uint64(b_poly), np.uint64(mu),
+                                            gamma))
+    if debug:
+        debug_print(f"Calculating f(x) mod b(x)", debug)
+        debug_print(f"   f(x) mod b(x) = {remainder_poly:b}", debug)
+
+    # Unpack remainder to gamma bits
+    tau_binary = _int_to_bits(remainder_poly, gamma)
+    if debug:
+        debug_print(f"tau: {tau_binary} - len: {len(tau_binary)}", debug)
 
     # m' is m + theta + tau
-    new_m = padded_message + theta_binary + tau_binary
-    debug_print(f"\nm': {new_m}", debug)
+    new_m = np.concatenate((padded_message, theta_binary, tau_binary))
+    if debug:
+        debug_print(f"\nm': {new_m}", debug)
     return new_m
 
 
-def amdc_decode_message(encoded_message: list, message_length: int, beta: int, debug: bool) -> tuple[bool, list[int]]:
+def amdc_encode_message_batch(messages, beta: int, debug: bool) -> np.ndarray:
+    """
+    Encodes many messages of the same length with an AMDC, every message gets its own random theta.
+    The messages are stored as rows of one bit matrix and their polynomials as uint64 lanes, so every Horner step is
+    done for all messages at once
+    :param messages: list of messages or 2-D uint8 array with one message per row, each as a field of 0's and 1's
+    :param beta: probability that error is detected is 1-2**-beta
+    :param debug: if True prints out calculation steps
+    :return: uint8 array with one encoded message of 0's and 1's per row
+    """
+    if len(messages) == 0:
+        return np.empty((0, 0), dtype=np.uint8)
+    m_len = len(messages[0])
+    if any(len(message) != m_len for message in messages):
+        raise ValueError("All messages of a batch need to have the same length")
+    number_of_messages = len(messages)
+    message_matrix = np.asarray(messages, dtype=np.uint8).reshape(number_of_messages, m_len)
+
+    debug_print(f"----------Encoding {number_of_messages} messages with AMDC----------", debug)
+    # gamma is at most 30 for the polynomials in the .yaml file, so products of two polynomials fit into uint64
+    d, gamma = find_d_and_gamma(beta, m_len, debug)
+    if debug:
+        debug_print(f"d = {d}, gamma = {gamma}", debug)
+
+    # Draw the random bits of all thetas at once, one row per message
+    theta_bytes = np.frombuffer(token_bytes(number_of_messages * ((gamma + 7) // 8)), dtype=np.uint8)
+    theta_matrix = np.unpackbits(theta_bytes.reshape(number_of_messages, -1), axis=1)[:, :gamma]
+
+    # Fill messages with 0 till length is d * gamma
+    padded_matrix = np.pad(message_matrix, ((0, 0), (0, d * gamma - m_len)))
+
+    # Create polynomials, bit i of an uint64 lane is the coefficient of x^i
+    b_poly = _get_binary_irreducible_poly(gamma)
+    bit_values = np.uint64(1) << np.arange(gamma - 1, -1, -1, dtype=np.uint64)
+    theta_lanes = theta_matrix.astype(np.uint64) @ bit_values
+    u_lanes = padded_matrix.reshape(number_of_messages, d, gamma).astype(np.uint64) @ bit_values
+
+    # Calculate f(x) mod b(x) in Horner form for all messages at once
+    remainder_lanes = _clmod_lanes(_clmul_lanes(theta_lanes, theta_lanes, gamma), b_poly, gamma)
+    for i in range(d - 1, -1, -1):
+        remainder_lanes = _clmod_lanes(_clmul_lanes(remainder_lanes ^ u_lanes[:, i], theta_lanes, gamma), b_poly,
+                                       gamma)
+
+    # Unpack remainders to gamma bits
+    tau_matrix = ((remainder_lanes[:, None] >> np.arange(gamma - 1, -1, -1, dtype=np.uint64)) & np.uint64(1))
+    tau_matrix = tau_matrix.astype(np.uint8)
+
+    # m' is m + theta + tau
+    new_m_list = np.concatenate((padded_matrix, theta_matrix, tau_matrix), axis=1)
+    if debug:
+        for new_m in new_m_list:
+            debug_print(f"m': {new_m}", debug)
+    return new_m_list
+
+
+def amdc_decode_message(encoded_message, message_length: int, beta: int, debug: bool) -> tuple[bool, np.ndarray]:
     """
     Decodes a message with AMDC
-    :param encoded_message: encoded message as list of 0's and 1's
+    :param encoded_message: encoded message as field of 0's and 1's, list or uint8 array
     :param message_length: length of the original message
     :param beta: beta parameter
     :param debug: if True, prints out steps
-    :return: bool message is correct True or False, list of decoded message
+    :return: bool message is correct True or False, decoded message as uint8 array of 0's and 1's
     """
     debug_print("----------DECODING AMDC----------", debug)
     d, gamma = find_d_and_gamma(beta, message_length, debug)
-    debug_print(f"d = {d}, gamma = {gamma}", debug)
+    if debug:
+        debug_print(f"d = {d}, gamma = {gamma}", debug)
 
+    encoded_message = np.asarray(encoded_message, dtype=np.uint8)
     padded_message = encoded_message[:-2 * gamma]
     theta_binary = encoded_message[-2 * gamma: -gamma]
     tau_binary_received = encoded_message[-gamma:]
-
-    debug_print(f"Received message = {padded_message}", debug)
-    debug_print(f"Received theta_binary = {theta_binary}", debug)
-    debug_print(f"Received tau_binary = {tau_binary_received}", debug)
+    if debug:
+        debug_print(f"Received message = {padded_message}", debug)
+        debug_print(f"Received theta_binary = {theta_binary}", debug)
+        debug_print(f"Received tau_binary = {tau_binary_received}", debug)
 
     # Get irreducible polynomial from list
-    b = get_binary_irreducible(gamma)
-    debug_print(f"Get b from dict: {b}", debug)
-    b_binary = [int(d) for d in str(b)]
-
-    # Create polynomials
-    debug_print("Creating polynomials", debug)
-    gf = galois.GF(2)
-    b_poly = galois.Poly(b_binary, gf)
-    debug_print(f"b_poly = {b_poly}", debug)
-    theta_poly = galois.Poly(theta_binary, gf)
-    debug_print(f"theta_poly = {theta_poly}", debug)
-    u_poly_list = [galois.Poly(u, gf) for u in np.array_split(padded_message, d)]
-    debug_print(f"u_poly_list = {u_poly_list}", debug)
-    for u in u_poly_list:
-        debug_print(f"   u{u_poly_list.index(u)} = {u}", debug)
-
-    # Calculate f(x)
-    debug_print(f"Calculating f(x)", debug)
-    f_poly = theta_poly ** (d + 2)
-    for i in range(1, d + 1):
-        f_poly += u_poly_list[i - 1] * (theta_poly ** i)
-
-    debug_print(f"   f(x) = \n{f_poly}", debug)
-
-    # Divide f(x)/b(x)
-    quotient_poly = f_poly // b_poly
-    remainder_poly = f_poly % b_poly
-    debug_print("Calculate f(x)/b(x)", debug)
-    debug_print(f"quotient = {quotient_poly}\nremainder = {remainder_poly}", debug)
-
-    # cast np array to int_list, do modulo 2 and fill it with leading 0
-    tau_binary_calculated = list(map(int, bin(remainder_poly)[2:]))
-    tau_binary_calculated = [0] * (gamma - len(tau_binary_calculated)) + tau_binary_calculated
-    debug_print(f"\ntau_calculated: {tau_binary_calculated} - len: {len(tau_binary_calculated)}", debug)
-    debug_print(f"\ntau_received:   {tau_binary_received} - len: {len(tau_binary_received)}", debug)
-
-    if tau_binary_calculated == tau_binary_received:
-        message_correct = True
-    else:
-        message_correct = False
+    b_poly = _get_binary_irreducible_poly(gamma)
+
+    # Create polynomials, bit i of an int is the coefficient of x^i
+    theta_poly = _bits_to_int(theta_binary)
+    u_poly_list = _split_into_polys(padded_message, d, gamma)
+    if debug:
+        _debug_print_polys(b_poly, theta_poly, u_poly_list)
+
+    # Calculate f(x) mod b(x)
+    mu = _get_barrett_constant(gamma)
+    remainder_poly = int(_calculate_f_mod_b(np.uint64(theta_poly), u_poly_list, np.uint64(b_poly), np.uint64(mu),
+                                            gamma))
+    if debug:
+        debug_print(f"Calculating f(x) mod b(x)", debug)
+        debug_print(f"   f(x) mod b(x) = {remainder_poly:b}", debug)
+
+    # Compare calculated and received tau as polynomials
+    tau_received_poly = _bits_to_int(tau_binary_received)
+    if debug:
+        debug_print(f"\ntau_calculated: {remainder_poly:0{gamma}b} - len: {gamma}", debug)
+        debug_print(f"\ntau_received:   {tau_received_poly:0{gamma}b} - len: {len(tau_binary_received)}", debug)
+
+    message_correct = remainder_poly == tau_received_poly
     return message_correct, padded_message[:message_length]
@@ -1,11 +1,25 @@
-from p2p_network.amdc_for_p2p import find_d_and_gamma
+import numpy as np
+
+
+def find_d_and_gamma_for_securities(securities: np.ndarray, m_len: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds d and gamma for every security parameter at once, same result as find_d_and_gamma for each of them
+    :param securities: array of security parameters
+    :param m_len: length of message
+    :return: arrays of d and gamma, one entry per security parameter
+    """
+    # d = m_len always fulfills d * (beta + log2(d + 1)) >= m_len, so only odd d up to there are candidates
+    d_range = np.arange(1, max(m_len, 1) + 2, 2)
+    results = d_range * (securities[:, None] + np.log2(d_range + 1))
+    d = d_range[(results >= m_len).argmax(axis=1)]
+    gamma = np.ceil(securities + np.log2(d + 1)).astype(int)
+    return d, gamma
 
 
 if __name__ == "__main__":
     m_len = int(input("Input message length: "))
     # sec = int(input("Input security: "))
-    sec = [i for i in range(1, 16)]
+    sec = np.arange(1, 16)
     print(f"m_len sec m'_len")
-    for s in sec:
-        d, gamma = find_d_and_gamma(s, m_len, False)
+    for s, d, gamma in zip(sec, *find_d_and_gamma_for_securities(sec, m_len)):
         print(f"{m_len:3d}  {s:2d}  {d * gamma + 2 * gamma:4d}")
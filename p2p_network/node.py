@@ -8,20 +8,95 @@ Python package p2pnet for implementing decentralized peer-to-peer network applic
 Modified by Gabriel Seegerer
 """
 
+import os
 import socket
-import time
+import selectors
+import struct
 import threading
-import random
-import hashlib
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from secrets import token_hex
 from p2p_network.node_connection import NodeConnection
 
 
+def _recv_exact(sock, length):
+    """
+    Receives exactly length bytes from the socket, a single recv may return less bytes than requested.
+    :param sock: socket to receive from
+    :param length: number of bytes to receive
+    :return: received bytes
+    """
+    buffer = bytearray()
+    while len(buffer) < length:
+        chunk = sock.recv(length - len(buffer))
+        if not chunk:
+            raise EOFError("Connection closed during the handshake")
+        buffer += chunk
+    return bytes(buffer)
+
+
+class PendingHandshake:
+    """
+    Inbound connection whose handshake has not been received completely. The main loop of the node receives it piece
+    by piece whenever the socket is readable, so a slow or silent node does not block the other connections.
+    """
+
+    def __init__(self, sock, client_address, header, deadline):
+        """
+        :param sock: non-blocking socket of the accepted connection
+        :param client_address: address of the connected node
+        :param header: struct of the length in front of the handshake message
+        :param deadline: time.monotonic() until which the handshake has to be received
+        """
+        self.sock = sock
+        self.client_address = client_address
+        self.header = header
+        self.deadline = deadline
+        self.buffer = bytearray()
+        self.length = None  # Length of the handshake message, None while the header is being received
+
+    def receive(self):
+        """
+        Receives the available bytes of the handshake without blocking. Never receives more than the handshake, the
+        following data belongs to the node connection.
+        :return: decoded handshake message when it is complete, otherwise None
+        """
+        while True:
+            if self.length is None and len(self.buffer) == self.header.size:
+                (self.length,) = self.header.unpack(self.buffer)
+                self.buffer.clear()
+            if self.length is not None and len(self.buffer) == self.length:
+                return self.buffer.decode('utf-8')
+
+            needed = (self.header.size if self.length is None else self.length) - len(self.buffer)
+            try:
+                chunk = self.sock.recv(needed)
+            except BlockingIOError:
+                return None
+            if not chunk:
+                raise EOFError("Connection closed during the handshake")
+            self.buffer += chunk
+
+
 class Node(threading.Thread):
     """
     Implements a node that is able to connect to other nodes and is able to accept connections from other nodes.
     After instantiation, the node creates a TCP/IP server with the given port.
     """
 
+    # Length prefix of the handshake messages that exchange the ids of the nodes
+    HANDSHAKE_HEADER = struct.Struct('<H')
+
+    # Seconds a connecting node has to send its handshake, afterwards the connection is closed
+    HANDSHAKE_TIMEOUT = 10.0
+
+    # Seconds the queued packets of all connections may take to be sent when the node stops
+    SHUTDOWN_FLUSH_TIMEOUT = 2.0
+
+    # Size of the kernel send and receive buffers of all sockets
+    SOCKET_BUFFER_SIZE = 262144
+
     def __init__(self, host, port, node_id=None, max_connections=100):
         """
         Create instance of a Node. If you want to implement the Node functionality with a callback, you should
@@ -40,13 +115,25 @@ class Node(threading.Thread):
         self.port = port
 
         # Nodes that have established a connection with this node
-        self.nodes_inbound = set()  # Nodes that are connect with us N->(US)
+        self.nodes_inbound = {}  # Nodes that are connect with us N->(US), by their node id
 
         # Nodes that this node is connected to
-        self.nodes_outbound = set()  # Nodes that we are connected to (US)->N
+        self.nodes_outbound = {}  # Nodes that we are connected to (US)->N, by their node id
+        self.nodes_outbound_by_address = {}  # The same nodes by the (host, port) we have connected to
+
+        # Guards changes of nodes_inbound and nodes_outbound, iterate over the snapshot of all_nodes instead
+        self.peers_lock = threading.Lock()
+
+        # Immutable snapshot of all the nodes, it is replaced as a whole on every change, so it can be read without lock
+        self.peer_snapshot = ()
 
-        # A list of nodes that should be reconnected to whenever the connection was lost
-        self.reconnect_to_nodes = []
+        # Nodes that should be reconnected to whenever the connection was lost, by their (host, port)
+        self.reconnect_to_nodes = {}
+
+        # Seconds between the checks whether the nodes in reconnect_to_nodes are still connected
+        self.reconnect_interval = 5.0
+        self.reconnect_lock = threading.Lock()
+        self.reconnect_timer = None
 
         # Create a unique ID for each node if the ID is not given.
         if node_id is None:
@@ -54,6 +141,34 @@ class Node(threading.Thread):
         else:
             self.node_id = str(node_id)  # Make sure the ID is a string!
 
+        # The handshake messages never change, so they are encoded only once
+        self.id_handshake = self.encode_handshake(self.node_id)
+        self.id_port_handshake = self.encode_handshake(self.node_id + ":" + str(self.port))
+
+        # Single selector that watches the server socket and all node connections
+        self.selector = selectors.DefaultSelector()
+
+        # Accepted connections that have not completed their handshake yet, by their socket
+        self.pending_handshakes = {}
+
+        # Node connections that have been stopped and still need to be closed by the main loop
+        self.stopped_connections = deque()
+
+        # Node connections that have queued packets and need to be watched for writing by the main loop
+        self.write_requests = deque()
+        self.wakeup_pending = False
+
+        # Threads that invoke node_message, so a slow callback does not block the main loop. The number of threads
+        # depends on the number of CPUs, not on the number of connections.
+        self.message_workers = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 2),
+                                                  thread_name_prefix=f"Node-{self.port}-message")
+
+        # Socket pair to wake up the main loop from other threads
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ)
+
         # Start the TCP/IP server
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.init_server()
@@ -72,9 +187,16 @@ class Node(threading.Thread):
     @property
     def all_nodes(self):
         """
-        Return a list of all the nodes, inbound and outbound, that are connected with this node.
+        Return a tuple of all the nodes, inbound and outbound, that are connected with this node.
         """
-        return self.nodes_inbound | self.nodes_outbound
+        return self.peer_snapshot
+
+    def update_peer_snapshot(self):
+        """
+        Rebuilds the snapshot of all the nodes. Has to be invoked with the peers_lock held after every change of
+        nodes_inbound or nodes_outbound.
+        """
+        self.peer_snapshot = (*self.nodes_inbound.values(), *self.nodes_outbound.values())
 
     def debug_print_network(self, message):
         """
@@ -85,12 +207,9 @@ class Node(threading.Thread):
 
     def generate_id(self):
         """
-        Generates a unique ID for each node.
+        Generates a unique ID for each node, 128 random hex characters.
         """
-        gen_id = hashlib.sha512()
-        t = self.host + str(self.port) + str(random.randint(1, 99999999))
-        gen_id.update(t.encode('ascii'))
-        return gen_id.hexdigest()
+        return token_hex(64)
 
     def init_server(self):
         """
@@ -98,10 +217,41 @@ class Node(threading.Thread):
         """
         print("Initialisation of the Node on port: " + str(self.port) + " on node (" + self.node_id + ")")
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.set_socket_buffer_sizes(self.sock)  # Inherited by the accepted connections
         self.sock.bind((self.host, self.port))
         self.sock.settimeout(10.0)
         # TODO listen(1) previously, why?
         self.sock.listen()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
+    def set_socket_buffer_sizes(self, sock):
+        """
+        Enlarges the kernel send and receive buffers of the socket, so large packets need fewer system calls.
+        """
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.SOCKET_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SOCKET_BUFFER_SIZE)
+
+    def set_connection_options(self, sock):
+        """
+        Disables Nagle's algorithm, so small packets are sent without delay, and enables keep alive, so dead
+        connections are detected by the operating system.
+        """
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    def encode_handshake(self, message):
+        """
+        Encodes a handshake message with its length in front of it.
+        """
+        encoded_message = message.encode('utf-8')
+        return self.HANDSHAKE_HEADER.pack(len(encoded_message)) + encoded_message
+
+    def receive_handshake(self, sock):
+        """
+        Receives a complete handshake message that has been encoded by encode_handshake.
+        """
+        (length,) = self.HANDSHAKE_HEADER.unpack(_recv_exact(sock, self.HANDSHAKE_HEADER.size))
+        return _recv_exact(sock, length).decode('utf-8')
 
     def print_connections(self):
         """
@@ -115,35 +265,47 @@ class Node(threading.Thread):
         """
         Send a message to all the nodes that are connected with this node. data is a python variable which is converted
         to JSON that is sent over to the other node. exclude list gives all the nodes to which this data should not be
-        sent.
+        sent. The data is encoded only once for all the nodes.
         """
-        if exclude is None:
-            exclude = []
-        self.message_count_sent = self.message_count_sent + 1
-        for n in self.nodes_inbound:
-            if n in exclude:
-                self.debug_print_network("Node send_to_nodes: Excluding node in sending the message")
-            else:
-                self.send_to_node(n, data)
+        exclude = set(exclude) if exclude else set()
+
+        try:
+            packet = NodeConnection.encode_packet(data)
+
+        except TypeError as type_error:
+            self.debug_print_network('Node send_to_nodes: This data is invalid')
+            self.debug_print_network(type_error)
+            return
 
-        for n in self.nodes_outbound:
+        self.message_count_sent = self.message_count_sent + 1
+        for n in self.all_nodes:
             if n in exclude:
                 self.debug_print_network("Node send_to_nodes: Excluding node in sending the message")
             else:
-                self.send_to_node(n, data)
+                n.send_raw(packet)
 
     def send_to_node_by_id(self, receiver_id, data):
-        self.message_count_sent += 1
-        for n in self.nodes_inbound | self.nodes_outbound:
-            if n.connected_node_id == str(receiver_id):
-                self.send_to_node(n, data)
+        """
+        Send the data to the node with the id receiver_id if it exists.
+        """
+        self.message_count_sent = self.message_count_sent + 1
+        receiver_id = str(receiver_id)
+        with self.peers_lock:
+            n = self.nodes_inbound.get(receiver_id) or self.nodes_outbound.get(receiver_id)
+        if n is not None:
+            n.send(data)
+        else:
+            self.debug_print_network("Node send_to_node_by_id: Could not send the data, node is not found!")
 
     def send_to_node(self, n, data):
         """
         Send the data to the node n if it exists.
         """
         self.message_count_sent = self.message_count_sent + 1
-        if n in self.nodes_inbound or n in self.nodes_outbound:
+        with self.peers_lock:
+            connected = (self.nodes_inbound.get(n.connected_node_id) is n
+                         or self.nodes_outbound.get(n.connected_node_id) is n)
+        if connected:
             n.send(data)
         else:
             self.debug_print_network("Node send_to_node: Could not send the data, node is not found!")
@@ -163,48 +325,54 @@ class Node(threading.Thread):
             return False
 
         # Check if node is already connected with this node!
-        for node in self.nodes_outbound:
-            if node.host == host and node.port == port:
-                print(f"connect_with_node: Already connected with this node ({node.node_id}).")
-                return True
+        node = self.nodes_outbound_by_address.get((host, port))
+        if node is not None:
+            print(f"connect_with_node: Already connected with this node ({node.connected_node_id}).")
+            return True
 
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_socket_buffer_sizes(sock)
             self.debug_print_network("connecting to %s port %s" % (host, port))
+            sock.settimeout(self.HANDSHAKE_TIMEOUT)
             sock.connect((host, port))
+            self.set_connection_options(sock)
 
             # Basic information exchange (not secure) of the id's of the nodes!
-            sock.send((self.node_id + ":" + str(self.port)).encode('utf-8'))  # Send id and port to the connected node!
-            connected_node_id = sock.recv(4096).decode('utf-8')  # When a node is connected, it sends its id!
+            sock.sendall(self.id_port_handshake)  # Send id and port to the connected node!
+            connected_node_id = self.receive_handshake(sock)  # When a node is connected, it sends its id!
 
             # Cannot connect with yourself
             if self.node_id == connected_node_id:
                 print("connect_with_node: You cannot connect with yourself?!")
-                sock.send("CLOSING: Already having a connection together".encode('utf-8'))
+                sock.send(NodeConnection.encode_packet("CLOSING: Already having a connection together"))
                 sock.close()
                 return True
 
             # Fix bug: Cannot connect with nodes that are already connected with us!
             #          Send message and close the socket.
-            for node in self.nodes_inbound:
-                if node.host == host and node.node_id == connected_node_id:
-                    print(f"connect_with_node: This node ({node.node_id}) is already connected with us.")
-                    sock.send("CLOSING: Already having a connection together".encode('utf-8'))
-                    sock.close()
-                    return True
+            if connected_node_id in self.nodes_inbound:
+                print(f"connect_with_node: This node ({connected_node_id}) is already connected with us.")
+                sock.send(NodeConnection.encode_packet("CLOSING: Already having a connection together"))
+                sock.close()
+                return True
 
-            thread_client = self.create_new_connection(sock, connected_node_id, host, port)
-            thread_client.start()
+            node_connection = self.create_new_connection(sock, connected_node_id, host, port)
+            self.register_connection(node_connection)
 
-            self.nodes_outbound.add(thread_client)
-            self.outbound_node_connected(thread_client)
+            with self.peers_lock:
+                self.nodes_outbound[node_connection.connected_node_id] = node_connection
+                self.nodes_outbound_by_address[(host, port)] = node_connection
+                self.update_peer_snapshot()
+            self.outbound_node_connected(node_connection)
 
             # If reconnection to this host is required, it will be added to the list!
             if reconnect:
                 self.debug_print_network(f"connect_with_node: Reconnection check is enabled on node {host}:{str(port)}")
-                self.reconnect_to_nodes.append({
-                    "host": host, "port": port, "tries": 0
-                })
+                self.reconnect_to_nodes[(host, port)] = {
+                    "host": host, "port": port, "trials": 0
+                }
+                self.schedule_reconnect_nodes()
 
             return True
 
@@ -214,11 +382,11 @@ class Node(threading.Thread):
 
     def disconnect_with_node(self, node):
         """
-        Disconnect the TCP/IP connection with the specified node. It stops the node and joins the thread. The node
+        Disconnect the TCP/IP connection with the specified node. It stops the node connection. The node
         will be deleted from the nodes_outbound list. Before closing, the method node_disconnect_with_outbound_node
         is invoked.
         """
-        if node in self.nodes_outbound:
+        if self.nodes_outbound.get(node.connected_node_id) is node:
             self.node_disconnect_with_outbound_node(node)
             node.stop()
 
@@ -233,6 +401,11 @@ class Node(threading.Thread):
         # self.node_request_to_stop()
         self.debug_print_network(f"{self.node_id} is requested to stop!")
         self.terminate_flag.set()
+        self.wakeup()
+
+        with self.reconnect_lock:
+            if self.reconnect_timer is not None:
+                self.reconnect_timer.cancel()
 
     # This method can be overridden when a different node-connection is required!
     def create_new_connection(self, connection, connected_node_id, host, port):
@@ -247,19 +420,19 @@ class Node(threading.Thread):
         This method checks whether nodes that have the reconnection status are still connected. If not connected
         these nodes are started again.
         """
-        for node_to_check in self.reconnect_to_nodes:
-            found_node = False
+        with self.reconnect_lock:
+            self.reconnect_timer = None
+
+        for address, node_to_check in list(self.reconnect_to_nodes.items()):
             self.debug_print_network(
                 "reconnect_nodes: Checking node " + node_to_check["host"] + ":" + str(node_to_check["port"]))
 
-            for node in self.nodes_outbound:
-                if node.host == node_to_check["host"] and node.port == node_to_check["port"]:
-                    found_node = True
-                    node_to_check["trials"] = 0  # Reset the trials
-                    self.debug_print_network(
-                        f"reconnect_nodes: Node {node_to_check['host']}:{str(node_to_check['port'])} still running!")
+            if address in self.nodes_outbound_by_address:
+                node_to_check["trials"] = 0  # Reset the trials
+                self.debug_print_network(
+                    f"reconnect_nodes: Node {node_to_check['host']}:{str(node_to_check['port'])} still running!")
 
-            if not found_node:  # Reconnect with node
+            else:  # Reconnect with node
                 node_to_check["trials"] += 1
                 if self.node_reconnection_error(node_to_check["host"], node_to_check["port"], node_to_check["trials"]):
                     self.connect_with_node(node_to_check["host"],
@@ -268,63 +441,221 @@ class Node(threading.Thread):
                 else:
                     self.debug_print_network("reconnect_nodes: Removing node (" + node_to_check["host"] + ":" + str(
                         node_to_check["port"]) + ") from the reconnection list!")
-                    self.reconnect_to_nodes.remove(node_to_check)
+                    del self.reconnect_to_nodes[address]
 
-    def run(self):
+        self.schedule_reconnect_nodes()
+
+    def schedule_reconnect_nodes(self):
         """
-        The main loop of the thread that deals with connections from other nodes on the network. When a node is
-        connected it will exchange the node id's. First we receive the id of the connected node, and secondly we will
-        send our node id to the connected node. When connected the method inbound_node_connected is invoked.
+        Starts a timer that invokes reconnect_nodes after reconnect_interval seconds, unless a timer is already running,
+        there are no nodes to reconnect or the node is stopping.
         """
-        while not self.terminate_flag.is_set():  # Check whether the thread needs to be closed
-            try:
-                # self.debug_print("Node: Wait for incoming connection")
-                connection, client_address = self.sock.accept()
+        with self.reconnect_lock:
+            if self.reconnect_timer is not None or not self.reconnect_to_nodes or self.terminate_flag.is_set():
+                return
+            self.reconnect_timer = threading.Timer(self.reconnect_interval, self.reconnect_nodes)
+            self.reconnect_timer.daemon = True
+            self.reconnect_timer.start()
 
-                self.debug_print_network(f"Total inbound connections: {str(len(self.nodes_inbound))}")
-                # When the maximum connections is reached, it disconnects the connection 
-                if len(self.nodes_inbound) < self.max_connections:
+    def register_connection(self, node_connection):
+        """
+        Registers the socket of the node connection at the selector, so the main loop receives its data.
+        """
+        self.selector.register(node_connection.sock, selectors.EVENT_READ, node_connection)
 
-                    # Basic information exchange (not secure) of the id's of the nodes!
-                    connected_node_port = client_address[1]  # backward compatibility
-                    connected_node_id = connection.recv(4096).decode('utf-8')
-                    if ":" in connected_node_id:
-                        # When a node is connected, it sends its id!
-                        (connected_node_id, connected_node_port) = connected_node_id.split(':')
-                    connection.send(self.node_id.encode('utf-8'))  # Send my id to the connected node!
+    def wakeup(self):
+        """
+        Wakes up the main loop when it is waiting in the selector.
+        """
+        try:
+            self.wakeup_sender.send(b'\x00')
 
-                    thread_client = self.create_new_connection(connection, connected_node_id, client_address[0],
-                                                               connected_node_port)
-                    thread_client.start()
+        except BlockingIOError:
+            pass  # The main loop has not yet consumed the previous wakeups, so it is awake anyway
 
-                    self.nodes_inbound.add(thread_client)
-                    self.inbound_node_connected(thread_client)
+        except OSError:
+            pass  # The main loop has already been stopped
 
-                else:
-                    self.debug_print_network("New connection is closed. You have reached the maximum connection limit!")
-                    connection.close()
+    def request_write(self, node_connection):
+        """
+        Is invoked by a node connection that has queued packets. The main loop will send them when the socket is able
+        to send data.
+        """
+        self.write_requests.append(node_connection)
+        if not self.wakeup_pending:
+            self.wakeup_pending = True
+            self.wakeup()
 
-            except socket.timeout:
-                # self.debug_print('Node: Connection timeout!')
-                pass
+    def handle_write_requests(self):
+        """
+        Watches the sockets of all node connections that have requested to write since the last call for writing.
+        """
+        self.wakeup_pending = False
+        while self.write_requests:
+            node_connection = self.write_requests.popleft()
+            if not node_connection.terminate_flag.is_set():
+                self.selector.modify(node_connection.sock, selectors.EVENT_READ | selectors.EVENT_WRITE,
+                                     node_connection)
 
-            except Exception as e:
-                raise e
+    def close_stopped_connections(self):
+        """
+        Unregisters and closes all node connections that have been stopped since the last call.
+        """
+        while self.stopped_connections:
+            node_connection = self.stopped_connections.popleft()
+            self.selector.unregister(node_connection.sock)
+            node_connection.close()
 
-            if not self.terminate_flag.is_set():
-                self.reconnect_nodes()
+    def accept_connection(self):
+        """
+        Accepts a connection from another node. The handshake of the connection is received by the main loop without
+        blocking, see handle_handshake.
+        """
+        try:
+            connection, client_address = self.sock.accept()
 
-            time.sleep(0.01)
+        except (socket.timeout, BlockingIOError):
+            return
 
-        print(f"({self.node_id}):Node stopping...")
+        except OSError as e:
+            self.debug_print_network(f"Node accept_connection: {str(e)}")
+            return
 
-        tmp_nodes = self.all_nodes
-        for t in tmp_nodes:
-            t.stop()
+        self.debug_print_network(f"Total inbound connections: {str(len(self.nodes_inbound))}")
+        # When the maximum connections is reached, it disconnects the connection
+        if len(self.nodes_inbound) + len(self.pending_handshakes) >= self.max_connections:
+            self.debug_print_network("New connection is closed. You have reached the maximum connection limit!")
+            connection.close()
+            return
+
+        try:
+            self.set_connection_options(connection)
+            connection.setblocking(False)
+
+        except OSError as e:
+            self.debug_print_network(f"Node accept_connection: {str(e)}")
+            connection.close()
+            return
+
+        pending = PendingHandshake(connection, client_address, self.HANDSHAKE_HEADER,
+                                   time.monotonic() + self.HANDSHAKE_TIMEOUT)
+        self.pending_handshakes[connection] = pending
+        self.selector.register(connection, selectors.EVENT_READ, pending)
+
+    def handle_handshake(self, pending):
+        """
+        Is invoked by the main loop when the socket of a pending handshake is readable. When the handshake is
+        complete, we send our node id to the connected node and the method inbound_node_connected is invoked.
+        """
+        try:
+            connected_node_id = pending.receive()
+            if connected_node_id is None:
+                return  # The rest of the handshake has not been received yet
+
+            self.selector.unregister(pending.sock)
+            del self.pending_handshakes[pending.sock]
+
+            # Basic information exchange (not secure) of the id's of the nodes!
+            connected_node_port = pending.client_address[1]  # backward compatibility
+            if ":" in connected_node_id:
+                # When a node is connected, it sends its id!
+                (connected_node_id, connected_node_port) = connected_node_id.rsplit(':', 1)
+            pending.sock.sendall(self.id_handshake)  # Send my id to the connected node!
+
+        except (EOFError, OSError, UnicodeDecodeError) as e:
+            self.debug_print_network(f"Node handle_handshake: {str(e)}")
+            self.close_pending_handshake(pending)
+            return
+
+        node_connection = self.create_new_connection(pending.sock, connected_node_id, pending.client_address[0],
+                                                     connected_node_port)
+        self.register_connection(node_connection)
+
+        with self.peers_lock:
+            self.nodes_inbound[node_connection.connected_node_id] = node_connection
+            self.update_peer_snapshot()
+        self.inbound_node_connected(node_connection)
+
+    def close_pending_handshake(self, pending):
+        """
+        Closes the connection of a handshake that failed or has not been completed in time.
+        """
+        if self.pending_handshakes.pop(pending.sock, None) is not None:
+            self.selector.unregister(pending.sock)
+        pending.sock.close()
+
+    def expire_pending_handshakes(self):
+        """
+        Closes the connections that have not sent their handshake within HANDSHAKE_TIMEOUT seconds.
+        """
+        now = time.monotonic()
+        # All handshakes have the same timeout, so they expire in the order they have been accepted
+        while self.pending_handshakes:
+            pending = next(iter(self.pending_handshakes.values()))
+            if pending.deadline > now:
+                return
+            self.debug_print_network(f"Node: Handshake of {pending.client_address} timed out")
+            self.close_pending_handshake(pending)
 
-        for t in tmp_nodes:
-            t.join()
+    def selector_timeout(self):
+        """
+        Returns how long the main loop may wait in the selector. It only needs to wake up by itself to close a
+        handshake that timed out.
+        """
+        if self.pending_handshakes:
+            return max(next(iter(self.pending_handshakes.values())).deadline - time.monotonic(), 0.0)
+        return None
 
+    def run(self):
+        """
+        The main loop of the thread. A single selector waits for incoming connections from other nodes and for data of
+        all the connected nodes, so no thread per node connection is needed. The selector blocks until something
+        happens, other threads use wakeup to interrupt it. Only when a handshake is pending, it wakes up by itself.
+        The reconnections are checked by a timer, see schedule_reconnect_nodes.
+        """
+        while not self.terminate_flag.is_set():  # Check whether the thread needs to be closed
+            for key, events in self.selector.select(timeout=self.selector_timeout()):
+                if key.fileobj is self.sock:
+                    self.accept_connection()
+                elif key.fileobj is self.wakeup_receiver:
+                    self.wakeup_receiver.recv(4096)
+                elif isinstance(key.data, PendingHandshake):
+                    self.handle_handshake(key.data)
+                else:
+                    try:
+                        if events & selectors.EVENT_WRITE:
+                            key.data.handle_writable()
+                        if events & selectors.EVENT_READ:
+                            key.data.handle_readable()
+
+                    except Exception as e:  # An error of one connection must not stop the main loop
+                        self.debug_print_network(f"Node run: Error handling node {key.data.connected_node_id}: {e}")
+                        key.data.stop()
+
+            if self.pending_handshakes:
+                self.expire_pending_handshakes()
+
+            self.handle_write_requests()
+            self.close_stopped_connections()
+
+        print(f"({self.node_id}):Node stopping...")
+
+        # Send what has been queued before stopping, the connections that are already stopped are skipped
+        flush_deadline = time.monotonic() + self.SHUTDOWN_FLUSH_TIMEOUT
+        for t in self.all_nodes:
+            if not t.terminate_flag.is_set():
+                t.flush(flush_deadline - time.monotonic())
+
+        for t in self.all_nodes:
+            t.stop()
+        self.close_stopped_connections()
+        for pending in list(self.pending_handshakes.values()):
+            self.close_pending_handshake(pending)
+
+        self.message_workers.shutdown(wait=False)
+        self.selector.close()
+        self.wakeup_receiver.close()
+        self.wakeup_sender.close()
         self.sock.settimeout(None)
         self.sock.close()
         print(f"({self.node_id}): Node stopped")
@@ -349,12 +680,22 @@ class Node(threading.Thread):
         """
         self.debug_print_network(f"node_disconnected: {node_connection.connected_node_id}")
 
-        if node_connection in self.nodes_inbound:
-            self.nodes_inbound.remove(node_connection)
+        with self.peers_lock:
+            inbound = self.nodes_inbound.get(node_connection.connected_node_id) is node_connection
+            if inbound:
+                del self.nodes_inbound[node_connection.connected_node_id]
+
+            outbound = self.nodes_outbound.get(node_connection.connected_node_id) is node_connection
+            if outbound:
+                del self.nodes_outbound[node_connection.connected_node_id]
+                del self.nodes_outbound_by_address[(node_connection.host, node_connection.port)]
+
+            self.update_peer_snapshot()
+
+        if inbound:
             self.inbound_node_disconnected(node_connection)
 
-        if node_connection in self.nodes_outbound:
-            self.nodes_outbound.remove(node_connection)
+        if outbound:
             self.outbound_node_disconnected(node_connection)
 
     def inbound_node_disconnected(self, node_connection):
@@ -9,13 +9,99 @@ Modified by Gabriel Seegerer
 """
 
 import json
-import pickle
+import selectors
 import socket
+import struct
 import threading
-import time
+import traceback
+import msgpack
+from collections import deque
+from functools import lru_cache
 
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:  # orjson is optional, fall back to the json module of the standard library
+    def json_dumps(data) -> bytes:
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
 
-class NodeConnection(threading.Thread):
+    def json_loads(packet):
+        return json.loads(str(packet, 'utf-8'))
+
+# Value types of small dicts whose encoded packets are cached, control messages like {"parity_finished": True} are
+# sent over and over again
+CACHED_VALUE_TYPES = (str, int, float, bool, type(None))
+
+# Maximum number of entries and maximum length of strings in the packet cache
+MAX_CACHED_ITEMS = 8
+MAX_CACHED_LENGTH = 256
+
+
+def _json_cache_key(data: dict):
+    """
+    Creates a hashable snapshot of a small dict with str keys and scalar values, to look up its encoded packet.
+    :param data: dict to be sent
+    :return: tuple of (key, type, value) triples or None if the dict should not be cached
+    """
+    if len(data) > MAX_CACHED_ITEMS:
+        return None
+    cache_key = []
+    for key, value in data.items():
+        value_type = type(value)
+        if type(key) is not str or value_type not in CACHED_VALUE_TYPES or (
+                value_type is str and len(value) > MAX_CACHED_LENGTH):
+            return None
+        # The type is part of the key, as True == 1 == 1.0 would otherwise share one entry
+        cache_key.append((key, value_type, value))
+    return tuple(cache_key)
+
+
+@lru_cache(maxsize=256)
+def _encode_cached_str_packet(data: str, encoding_type: str) -> bytes:
+    """
+    Encodes a short string into a packet, the result is cached.
+    """
+    payload = data.encode(encoding_type)
+    return NodeConnection.HEADER.pack(len(payload), NodeConnection.PACKET_STR) + payload
+
+
+@lru_cache(maxsize=256)
+def _encode_cached_json_packet(cache_key: tuple) -> bytes:
+    """
+    Encodes the dict described by the cache key from _json_cache_key into a json packet, the result is cached.
+    """
+    payload = json_dumps({key: value for key, _, value in cache_key})
+    return NodeConnection.HEADER.pack(len(payload), NodeConnection.PACKET_JSON) + payload
+
+
+def _encode_str_packet(data: str, encoding_type: str) -> bytes:
+    """
+    Encodes a string into a packet, packets of short strings are cached.
+    """
+    if len(data) <= MAX_CACHED_LENGTH:
+        return _encode_cached_str_packet(data, encoding_type)
+    payload = data.encode(encoding_type)
+    return NodeConnection.HEADER.pack(len(payload), NodeConnection.PACKET_STR) + payload
+
+
+def _encode_json_packet(data: dict, _encoding_type: str) -> bytes:
+    """
+    Encodes a dict into a utf-8 json packet, packets of small dicts are cached.
+    """
+    cache_key = _json_cache_key(data)
+    if cache_key is not None:
+        return _encode_cached_json_packet(cache_key)
+    payload = json_dumps(data)
+    return NodeConnection.HEADER.pack(len(payload), NodeConnection.PACKET_JSON) + payload
+
+
+def _encode_bytes_packet(data: bytes, _encoding_type: str) -> bytes:
+    """
+    Encodes bytes into a packet.
+    """
+    return NodeConnection.HEADER.pack(len(data), NodeConnection.PACKET_BYTES) + data
+
+
+class NodeConnection:
     """
     The class NodeConnection is used by the class Node and represent the TCP/IP socket connection with another node.
     Both inbound (nodes that connect with the server) and outbound (nodes that are connected to) are represented by
@@ -23,8 +109,8 @@ class NodeConnection(threading.Thread):
     Communication is done by this class. When a connecting node sends a message, the message is relayed to the main
     node (that created this NodeConnection in the first place).
        
-    Instantiates a new NodeConnection. Do not forget to start the thread. All TCP/IP communication is handled by this
-    connection.
+    Instantiates a new NodeConnection. The main node registers the socket at its selector and invokes
+    handle_readable whenever data is available. All TCP/IP communication is handled by this connection.
         main_node: The Node class that received a connection.
         sock: The socket that is associated with the client connection.
         id: The id of the connected node (at the other side of the TCP/IP connection).
@@ -32,10 +118,32 @@ class NodeConnection(threading.Thread):
         port: The port of the server of the main node.
     """
 
+    # Every packet starts with a header holding the length of the payload and the type of the packet. Binary
+    # payloads may contain any byte, so the packets cannot be delimited by an end of transmission character.
+    HEADER = struct.Struct('<IB')
+    PACKET_STR = 0
+    PACKET_JSON = 1
+    PACKET_BYTES = 2
+    PACKET_MSGPACK = 3
+    PACKET_BATCH = 4  # msgpack array of data, every element is passed to node_message on its own
+
+    # Encoders of the data types that can be sent, looked up by the exact type of the data
+    ENCODERS = {str: _encode_str_packet, dict: _encode_json_packet, bytes: _encode_bytes_packet}
+
+    # Maximum number of packets waiting to be sent, further senders wait for the queue up to SEND_QUEUE_TIMEOUT seconds
+    # before the connection is stopped
+    MAX_QUEUED_PACKETS = 65536
+    SEND_QUEUE_TIMEOUT = 10.0
+
+    # Maximum number of queued packets that are sent together with a single system call
+    MAX_SEND_BATCH = 64
+
+    # Maximum number of bytes that are received with a single system call
+    RECV_SIZE = 65536
+
     def __init__(self, main_node, sock, connected_node_id, host, port):
         """
-        Instantiates a new NodeConnection. Do not forget to start the thread. All TCP/IP communication is handled by
-        this connection.
+        Instantiates a new NodeConnection. All TCP/IP communication is handled by this connection.
             main_node: The Node class that received a connection.
             sock: The socket that is associated with the client connection.
             id: The id of the connected node (at the other side of the TCP/IP connection).
@@ -52,141 +160,362 @@ class NodeConnection(threading.Thread):
         # The id of the connected node
         self.connected_node_id = str(connected_node_id)  # Make sure the ID is a string
 
-        # End of transmission character for the network streaming messages.
-        self.EOT_CHAR = 0x04.to_bytes(1, 'big')
+        # Hold the stream that comes in!
+        self.buffer = bytearray()
+
+        # Received data waiting to be passed to node_message by a worker of the main node, at most one worker processes
+        # the data of a connection at a time to keep the order of the data
+        self.inbox = deque()
+        self.inbox_lock = threading.Lock()
+        self.inbox_scheduled = False
+
+        # Packets waiting to be sent by the main loop of the main node
+        self.out_queue = deque()
+        self.write_lock = threading.Lock()
+        self.write_requested = False
+        # Notified when the main loop has sent packets while senders wait for space in the full queue, or when the
+        # connection is stopped
+        self.queue_space = threading.Condition(self.write_lock)
+        self.queue_waiters = 0
 
         # Datastore to store additional information concerning the node.
         self.info = {}
 
-        # Use socket timeout to determine problems with the connection
-        self.sock.settimeout(10.0)
+        # The main loop of the main node only reads and writes when the socket is ready
+        self.sock.setblocking(False)
 
         self.main_node.debug_print_network(
             f"NodeConnection: Started with client ({self.connected_node_id}) '{self.host}:{str(self.port)}'")
-        super(NodeConnection, self).__init__()
 
-    def send_pickle(self, data):
+    @classmethod
+    def encode_packet(cls, data, encoding_type='utf-8'):
+        """
+        Encode the data into a packet with a header. The data can be pure text (str), dict object (encoded as utf-8
+        json) and bytes object. Packets of short strings and small dicts are cached. Raises a TypeError when the data
+        cannot be encoded.
+        """
+        encoder = cls.ENCODERS.get(type(data))
+        if encoder is None:
+            # Subclasses like OrderedDict are encoded like their base class
+            encoder = next((cls.ENCODERS[base] for base in type(data).__mro__ if base in cls.ENCODERS), None)
+            if encoder is None:
+                raise TypeError("datatype used is not valid please use str, dict (will be send as json) or bytes")
+        return encoder(data, encoding_type)
+
+    @classmethod
+    def encode_packet_msgpack(cls, data):
+        """
+        Encode the data into a packet with a header. The data is serialized with msgpack. Raises a TypeError when the
+        data cannot be serialized.
+        """
+        payload = msgpack.packb(data, use_bin_type=True)
+        return cls.HEADER.pack(len(payload), cls.PACKET_MSGPACK) + payload
+
+    @staticmethod
+    def encode_batch_item(data):
+        """
+        Serialize the data with msgpack to become an element of a batch packet. Raises a TypeError when the data cannot
+        be serialized.
+        """
+        return msgpack.packb(data, use_bin_type=True)
+
+    @classmethod
+    def encode_batch_packet(cls, batch):
         """
-        Send the data to the connected node. Serialized with pickle
+        Encode a list of data that has been serialized with encode_batch_item into a single packet with a header.
         """
-        self.sock.sendall(pickle.dumps(data))
+        payload = msgpack.Packer().pack_array_header(len(batch)) + b''.join(batch)
+        return cls.HEADER.pack(len(payload), cls.PACKET_BATCH) + payload
 
     def send(self, data, encoding_type='utf-8'):
         """
         Send the data to the connected node. The data can be pure text (str), dict object (send as json) and bytes
-        object. When sending bytes object, it will be using standard socket communication. An end of transmission
-        character 0x04 utf-8/ascii will be used to decode the packets ate the other node. When the socket is corrupted
-        the node connection is closed.
+        object. A header with the length and the type of the data is used to decode the packets at the other node.
+        When the socket is corrupted the node connection is closed.
         """
-        if isinstance(data, str):
-            try:
-                self.sock.sendall(data.encode(encoding_type) + self.EOT_CHAR)
+        try:
+            packet = self.encode_packet(data, encoding_type)
 
-            except Exception as e:  # Fixed issue #19: When sending is corrupted, close the connection
-                self.main_node.debug_print_network(f"Node connection send: Error sending data to node: {str(e)}")
-                self.stop()  # Stopping node due to failure
+        except TypeError as type_error:
+            self.main_node.debug_print_network('This data is invalid')
+            self.main_node.debug_print_network(type_error)
+            return
 
-        elif isinstance(data, dict):
-            try:
-                self.sock.sendall(json.dumps(data).encode(encoding_type) + self.EOT_CHAR)
+        self.send_raw(packet)
+
+    def send_msgpack(self, data):
+        """
+        Send the data to the connected node. Serialized with msgpack
+        """
+        try:
+            packet = self.encode_packet_msgpack(data)
 
-            except TypeError as type_error:
-                self.main_node.debug_print_network('This dict is invalid')
-                self.main_node.debug_print_network(type_error)
+        except TypeError as type_error:
+            self.main_node.debug_print_network('This data is invalid')
+            self.main_node.debug_print_network(type_error)
+            return
 
-            except Exception as e:  # Fixed issue #19: When sending is corrupted, close the connection
-                self.main_node.debug_print_network(f"Node connection send: Error sending data to node: {str(e)}")
-                self.stop()  # Stopping node due to failure
+        self.send_raw(packet)
 
-        elif isinstance(data, bytes):
+    def send_raw(self, packet):
+        """
+        Queue a packet that is already encoded by encode_packet for the connected node. The packet is sent by the main
+        loop of the main node, so a slow node does not block the sender. When too many packets are waiting, the sender
+        waits until the main loop has sent some of them. When the node does not receive them within
+        SEND_QUEUE_TIMEOUT seconds, the connection is stopped, so the node is not waited for forever.
+        """
+        if len(self.out_queue) >= self.MAX_QUEUED_PACKETS and not self.wait_for_queue_space():
+            return
+
+        with self.write_lock:
+            self.out_queue.append(packet)
+            if self.write_requested:
+                return
+            self.write_requested = True
+
+        self.main_node.request_write(self)
+
+    def wait_for_queue_space(self):
+        """
+        Waits until the main loop has sent packets of the full queue. Stops the connection when the node has not
+        received any of them within SEND_QUEUE_TIMEOUT seconds.
+        :return: True if packets can be queued again, False if the connection is stopped
+        """
+        with self.write_lock:
+            self.queue_waiters += 1
             try:
-                self.sock.sendall(data + self.EOT_CHAR)
+                has_space = self.queue_space.wait_for(
+                    lambda: len(self.out_queue) < self.MAX_QUEUED_PACKETS or self.terminate_flag.is_set(),
+                    self.SEND_QUEUE_TIMEOUT)
+            finally:
+                self.queue_waiters -= 1
 
-            except Exception as e:  # Fixed issue #19: When sending is corrupted, close the connection
-                self.main_node.debug_print_network(f"Node connection send: Error sending data to node: {str(e)}")
-                self.stop()  # Stopping node due to failure
+        if self.terminate_flag.is_set():
+            return False
 
-        else:
-            self.main_node.debug_print_network(
-                "datatype used is not valid please use str, dict (will be send as json) or bytes")
+        if not has_space:
+            print(f"({self.main_node.node_id}): Node {self.connected_node_id} has not received the queued data for "
+                  f"{self.SEND_QUEUE_TIMEOUT}s, stopping the connection")
+            self.main_node.message_count_error += 1
+            self.stop()
+            return False
 
-    def stop(self):
+        return True
+
+    def send_packets(self, packets):
         """
-        Terminates the connection and the thread is stopped. Stop the node client. Please make sure you join the thread.
+        Sends the packets with a single gather write (writev) if the platform supports it. Returns the number of bytes
+        that have been sent.
         """
-        self.main_node.debug_print_network(
-            f"{self.main_node.node_id} stopping node connection to {self.connected_node_id}")
-        self.terminate_flag.set()
+        if len(packets) == 1:
+            return self.sock.send(packets[0])
+        if hasattr(socket.socket, 'sendmsg'):
+            return self.sock.sendmsg(packets)
+        return self.sock.send(b''.join(packets))
 
-    @staticmethod
-    def parse_packet_pickle(packet):
+    def handle_writable(self):
         """
-        Parse the packet and determines whether it has been sent in str, json or byte format. It returns the according
-        data.
+        Is invoked by the main node when the socket is able to send data. Sends as many queued packets as possible,
+        up to MAX_SEND_BATCH packets per system call. When the socket is corrupted the node connection is closed.
         """
-        return pickle.loads(packet)
+        self.send_queued_packets()
 
-    @staticmethod
-    def parse_packet(packet):
+        # A sender that starts waiting after this check sees the space itself, see wait_for_queue_space
+        if self.queue_waiters:
+            with self.write_lock:
+                self.queue_space.notify_all()
+
+    def send_queued_packets(self):
         """
-        Parse the packet and determines whether it has been sent in str, json or byte format. It returns the according
-        data.
+        Sends as many queued packets as possible, see handle_writable.
         """
         try:
-            packet_decoded = packet.decode('utf-8')
+            while self.out_queue:
+                packets = [self.out_queue[i] for i in range(min(len(self.out_queue), self.MAX_SEND_BATCH))]
+                sent = self.send_packets(packets)
+
+                for packet in packets:
+                    if sent < len(packet):
+                        if sent > 0:
+                            self.out_queue[0] = packet[sent:]
+                        return
+                    sent -= len(packet)
+                    self.out_queue.popleft()
+
+        except BlockingIOError:
+            return
+
+        except Exception as e:  # Fixed issue #19: When sending is corrupted, close the connection
+            self.main_node.debug_print_network(f"Node connection send: Error sending data to node: {str(e)}")
+            self.stop()  # Stopping node due to failure
+            return
+
+        with self.write_lock:
+            if self.out_queue:
+                return
+            self.write_requested = False
+            self.main_node.selector.modify(self.sock, selectors.EVENT_READ, self)
+
+    def flush(self, timeout):
+        """
+        Sends all queued packets with blocking writes. Is invoked by the main node when it stops, before the socket is
+        closed, so the data that has been sent right before stopping is not lost.
+        :param timeout: seconds the packets may take to be sent, the rest is dropped afterwards
+        """
+        with self.write_lock:
+            packets = list(self.out_queue)
+            self.out_queue.clear()
 
-            try:
-                return json.loads(packet_decoded)
+        if not packets:
+            return
 
-            except json.decoder.JSONDecodeError:
-                return packet_decoded
+        try:
+            self.sock.settimeout(max(timeout, 0.001))
+            self.sock.sendall(b''.join(packets))
 
-        except UnicodeDecodeError:
-            return packet
+        except OSError as e:
+            self.main_node.debug_print_network(f"Node connection flush: Error sending data to node: {str(e)}")
 
-    # Required to implement the Thread. This is the main loop of the node client.
-    def run(self):
+    def stop(self):
         """
-        The main loop of the thread to handle the connection with the node. Within the main loop the thread waits to
-        receive data from the node. If data is received the method node_message will be invoked of the main node to be
-        processed.
+        Terminates the connection. The socket is closed by the main loop of the main node.
         """
-        buffer = b''  # Hold the stream that comes in!
+        if self.terminate_flag.is_set():
+            return
+        self.main_node.debug_print_network(
+            f"{self.main_node.node_id} stopping node connection to {self.connected_node_id}")
+        self.terminate_flag.set()
+        with self.write_lock:
+            self.queue_space.notify_all()  # Senders waiting for space in the queue give up
+        self.main_node.stopped_connections.append(self)
+        self.main_node.wakeup()
 
-        while not self.terminate_flag.is_set():
-            chunk = b''
+    def close(self):
+        """
+        Closes the socket of the stopped connection and informs the main node.
+        """
+        self.sock.close()
+        self.main_node.node_disconnected(self)
+        self.main_node.debug_print_network("NodeConnection: Stopped")
 
-            try:
-                chunk = self.sock.recv(4096)
+    @staticmethod
+    def parse_packet_msgpack(packet):
+        """
+        Parse the packet that has been serialized with msgpack. It returns the according data.
+        """
+        return msgpack.unpackb(packet, raw=False)
+
+    @classmethod
+    def parse_packet(cls, packet, packet_type):
+        """
+        Parse the packet according to the type from its header, whether it has been sent in str, json, byte or
+        msgpack format. It returns the according data. The packet may be a memoryview of the receive buffer, the
+        returned data never refers to it.
+        """
+        if packet_type == cls.PACKET_JSON:
+            return json_loads(packet)
+
+        elif packet_type == cls.PACKET_STR:
+            return str(packet, 'utf-8')
 
-            except socket.timeout:
-                # self.main_node.debug_print("NodeConnection: timeout")
-                pass
+        elif packet_type == cls.PACKET_MSGPACK:
+            return cls.parse_packet_msgpack(packet)
 
-            except Exception as e:
-                self.terminate_flag.set()  # Exception occurred terminating the connection
-                self.main_node.debug_print_network('Unexpected error')
-                self.main_node.debug_print_network(e)
+        return bytes(packet)
 
-            if chunk != b'':
-                buffer += chunk
-                eot_pos = buffer.find(self.EOT_CHAR)
+    def handle_readable(self):
+        """
+        Is invoked by the main node when data of the node is available. The data is received and for every complete
+        packet the method node_message will be invoked of the main node to be processed, see process_inbox.
+        """
+        try:
+            chunk = self.sock.recv(self.RECV_SIZE)
+
+        except BlockingIOError:
+            return
+
+        except Exception as e:
+            self.main_node.debug_print_network('Unexpected error')
+            self.main_node.debug_print_network(e)
+            self.stop()  # Exception occurred terminating the connection
+            return
+
+        if chunk == b'':
+            self.main_node.debug_print_network("NodeConnection: Connection closed by the other node")
+            self.stop()
+            return
+
+        self.buffer += chunk
+        packet_start = 0
+
+        received_data = []
+        malformed = False
+
+        # The packets are parsed from views of the buffer without copying them, all views have to be released before
+        # the buffer can be resized again
+        with memoryview(self.buffer) as buffer_view:
+            while len(buffer_view) - packet_start >= self.HEADER.size:
+                length, packet_type = self.HEADER.unpack_from(buffer_view, packet_start)
+                packet_end = packet_start + self.HEADER.size + length
+                if packet_end > len(buffer_view):
+                    break  # The rest of the packet has not been received yet
+
+                with buffer_view[packet_start + self.HEADER.size:packet_end] as packet:
+                    try:
+                        if packet_type == self.PACKET_BATCH:
+                            batch = self.parse_packet_msgpack(packet)
+                            if not isinstance(batch, list):
+                                raise ValueError(f"Batch packet contains {type(batch).__name__} instead of a list")
+                            received_data.extend(batch)
+                        else:
+                            received_data.append(self.parse_packet(packet, packet_type))
+
+                    except Exception as e:
+                        self.main_node.debug_print_network(
+                            f"NodeConnection: Malformed packet of type {packet_type} from node "
+                            f"{self.connected_node_id}: {e}")
+                        malformed = True
+                        break
+                packet_start = packet_end
+
+        if malformed:
+            # The stream can not be trusted anymore, only the packets before the malformed one are processed
+            self.main_node.message_count_error += 1
+            self.buffer.clear()
+            self.stop()
+        else:
+            # Remove all complete packets at once
+            del self.buffer[:packet_start]
 
-                while eot_pos > 0:
-                    packet = buffer[:eot_pos]
-                    buffer = buffer[eot_pos + 1:]
+        if not received_data:
+            return
 
-                    self.main_node.message_count_recv += 1
-                    self.main_node.node_message(self, self.parse_packet(packet))
+        with self.inbox_lock:
+            self.inbox.extend(received_data)
+            if self.inbox_scheduled:
+                return  # The running worker will also process the new data
+            self.inbox_scheduled = True
 
-                    eot_pos = buffer.find(self.EOT_CHAR)
+        self.main_node.message_workers.submit(self.process_inbox)
 
-            time.sleep(0.01)
+    def process_inbox(self):
+        """
+        Is executed by a worker of the main node. Invokes the method node_message of the main node for all received
+        data in the order it has been received.
+        """
+        while True:
+            with self.inbox_lock:
+                if not self.inbox:
+                    self.inbox_scheduled = False
+                    return
+                data = self.inbox.popleft()
+
+            self.main_node.message_count_recv += 1
+            try:
+                self.main_node.node_message(self, data)
 
-        self.sock.settimeout(None)
-        self.sock.close()
-        self.main_node.node_disconnected(self)
-        self.main_node.debug_print_network("NodeConnection: Stopped")
+            except Exception:
+                traceback.print_exc()
 
     def set_info(self, key, value):
         self.info[key] = value
@@ -201,9 +530,3 @@ class NodeConnection(threading.Thread):
     def __repr__(self):
         return '<NodeConnection: Node {}:{} <-> Connection {}:{}>'.format(self.main_node.host, self.main_node.port,
                                                                           self.host, self.port)
-
-    def __hash__(self):
-        return hash(self.main_node.node_id + self.connected_node_id)
-
-    def __eq__(self, other):
-        return self.main_node == other.main_node and self.connected_node_id == other.node_id
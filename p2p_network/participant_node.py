@@ -9,14 +9,81 @@ https://github.com/macsnoeren/python-p2p-network
 The idea is, a network of ParticipantNodes gets created and they can execute various protocols
 """
 
-import itertools
-import time
+import threading
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from p2p_network.node import Node
-from secrets import randbits
+from p2p_network.node_connection import NodeConnection
+from secrets import token_bytes
 from p2p_network.amdc_for_p2p import amdc_encode_message, amdc_decode_message
 
 
+def _decode_str(payload: bytes) -> str:
+    return str(payload, "utf-8")
+
+
+def _decode_bit(payload: bytes) -> int:
+    return payload[0]
+
+
+def _decode_vector(payload: bytes) -> np.ndarray:
+    return np.frombuffer(payload, dtype=np.uint8)
+
+
+def _decode_flag(_payload: bytes) -> bool:
+    return True
+
+
+# Protocols of the messages between participants with the decoder of their value, the index is the tag of the message
+MESSAGE_PROTOCOLS = (
+    ("node_id", _decode_str),
+    ("parity_shared_key", _decode_bit),
+    ("parity_key_xor_result", _decode_bit),
+    ("parity_shared_key_vector", _decode_vector),
+    ("parity_key_xor_result_vector", _decode_vector),
+    ("veto_finished", _decode_flag),
+    ("collision_detection_finished", _decode_flag),
+    ("notification_finished", _decode_flag),
+    ("fixed_message_finished", _decode_flag),
+    ("message_finished", _decode_flag),
+)
+
+
+class BitBuffer:
+    """
+    Preallocated buffer for the bits a participant receives during a parity round. Bits are written at the current
+    length, clear only resets the length, so the buffer is allocated once and reused for every round
+    """
+    def __init__(self, size: int = 0):
+        """
+        Constructor for BitBuffer
+        :param size: number of bits the buffer can hold before it has to grow
+        """
+        self.bits = np.zeros(size, dtype=np.uint8)
+        self.length = 0
+
+    def append(self, bit: int) -> None:
+        if self.length == len(self.bits):
+            self.bits = np.concatenate((self.bits, np.zeros(max(self.length, 8), dtype=np.uint8)))
+        self.bits[self.length] = bit
+        self.length += 1
+
+    def clear(self) -> None:
+        self.length = 0
+
+    def values(self) -> np.ndarray:
+        """
+        :return: view of the bits that have been appended since the last clear
+        """
+        return self.bits[:self.length]
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return repr(self.values().tolist())
+
+
 # TODO "Network Manager" - distributes all nodes in network to new participant, ensures no node_ids are used double
 
 class ParticipantNode(Node):
@@ -24,6 +91,9 @@ class ParticipantNode(Node):
     Implements a participant in a p2p-network. Can do various anonymous communication protocols after connecting to
     other participants
     """
+    MESSAGE_TAGS = {protocol: tag for tag, (protocol, _) in enumerate(MESSAGE_PROTOCOLS)}
+    RANDOM_POOL_BYTES = 4096  # Random bytes that are requested from the operating system at once
+
     def __init__(self, host: str, port: int, node_id: str = None, max_connections: int = 1000,
                  print_protocols: bool = False, debug_protocols: bool = False):
         """
@@ -42,13 +112,31 @@ class ParticipantNode(Node):
         self.debug_protocols = debug_protocols
         self.print_protocols = print_protocols
         self.all_node_ids = []
+        self.node_id_index = {}  # Position of every node_id in all_node_ids
+        self.number_of_peers = len(self.all_nodes)
+        # Notified whenever the connected nodes changed, uses the peers_lock of the node
+        self.peers_changed = threading.Condition(self.peers_lock)
+
+        # Messages for every node connection, that are sent as a single packet by flush
+        self.pending_messages = {}
+        self.pending_messages_lock = threading.Lock()
+        # Notified whenever a received message got sorted into its list
+        self.message_sorted = threading.Condition()
+
+        # Random bits for the protocols, refilled with RANDOM_POOL_BYTES when used up
+        self.random_bit_pool = np.zeros(0, dtype=np.uint8)
+        self.random_bit_offset = 0
 
         self.parity_input = 0
-        self.parity_shared_keys = []
+        self.parity_shared_keys = BitBuffer()
         self.parity_broadcasts_last = False
-        self.parity_received_broadcast_values = []
+        self.parity_received_broadcast_values = BitBuffer()
         self.parity_result = 0
-        self.parity_finished = []
+
+        self.parity_input_vector = np.zeros(0, dtype=np.uint8)
+        self.parity_shared_key_vectors = []
+        self.parity_received_broadcast_vectors = []
+        self.parity_result_vector = np.zeros(0, dtype=np.uint8)
 
         self.veto_input = 0
         self.veto_result = 0
@@ -67,15 +155,32 @@ class ParticipantNode(Node):
         self.encoded_message_length = 99
         self.message_input = []
         self.message_amdc_encoded_input = []
+        self.message_amdc_encoded_future = None  # Encoding of message_input that runs in the background
+        # Own thread for the encoding, so it never delays or waits for the processing of the received messages
+        self.encode_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"Participant-{self.port}-encode")
         self.is_message_sender = False
         self.is_message_receiver = False
-        self.message_amdc_encoded_received_message = []
+        self.message_amdc_encoded_received_message = np.zeros(self.encoded_message_length, dtype=np.uint8)
         self.message_amdc_decoded_received_message = []
         self.message_received_str = ""
-        self.one_time_pad = []
+        self.one_time_pad = np.zeros(0, dtype=np.uint8)
         self.fixed_message_finished = []
         self.message_finished = []
 
+        # Appends the value of a received message to the list of its protocol
+        self.message_handlers = {
+            "node_id": self.all_node_ids.append,
+            "parity_shared_key": self.parity_shared_keys.append,
+            "parity_key_xor_result": self.parity_received_broadcast_values.append,
+            "parity_shared_key_vector": self.parity_shared_key_vectors.append,
+            "parity_key_xor_result_vector": self.parity_received_broadcast_vectors.append,
+            "veto_finished": self.veto_finished.append,
+            "collision_detection_finished": self.collision_detection_finished.append,
+            "notification_finished": self.notification_finished.append,
+            "fixed_message_finished": self.fixed_message_finished.append,
+            "message_finished": self.message_finished.append,
+        }
+
     # Message transmission
     def execute_message_transmission(self, security: int) -> None:
         """
@@ -88,8 +193,12 @@ class ParticipantNode(Node):
         """
         self.debug_print_protocols("----------Executing message transmission----------")
         self.create_order_in_all_node_ids()
+        self.message_amdc_encoded_future = None
         if self.notification_input != "":
             self.is_message_sender = True
+            # The encoding only depends on the message, so it is done while the other protocols are executed
+            self.message_amdc_encoded_future = self.encode_worker.submit(
+                amdc_encode_message, self.message_input, security, self.print_protocols)
         self.execute_collision_detection(security)
         match self.collision_detection_result:
             case 0:
@@ -119,8 +228,8 @@ class ParticipantNode(Node):
         Participant waits until every other participant is also finished with message transmission protocol
         """
         self.send_to_nodes({"message_finished": True})
-        self.wait_while_receiving(self.message_finished, len(self.all_nodes))
-        self.message_finished = []
+        self.wait_while_receiving(self.message_finished, self.number_of_peers)
+        self.message_finished.clear()
 
     # Fixed role message transmission
     def execute_fixed_role_message_transmission(self, security: int, bit_count: int) -> None:
@@ -137,20 +246,28 @@ class ParticipantNode(Node):
         self.debug_print_protocols(f"      Roles set: is sender: {self.is_message_sender} - "
                                    f"is receiver: {self.is_message_receiver}")
 
+        # sender inputs the amdc encoded message, receiver the one time pad, everybody else only zeros
+        self.parity_input_vector = np.zeros(bit_count, dtype=np.uint8)
+
         if self.is_message_receiver:
             self.create_one_time_pad(bit_count)
+            self.parity_input_vector = self.one_time_pad
 
         if self.is_message_sender:
-            self.message_amdc_encoded_input = amdc_encode_message(self.message_input, security, self.print_protocols)
+            if self.message_amdc_encoded_future is not None:
+                self.message_amdc_encoded_input = self.message_amdc_encoded_future.result()
+                self.message_amdc_encoded_future = None
+            else:
+                self.message_amdc_encoded_input = amdc_encode_message(
+                    self.message_input, security, self.print_protocols)
             if len(self.message_amdc_encoded_input) != self.encoded_message_length:
                 raise ValueError(
                     f"Length should be {self.encoded_message_length}, is {len(self.message_amdc_encoded_input)}")
+            self.parity_input_vector = np.asarray(self.message_amdc_encoded_input, dtype=np.uint8)
 
-        for round_of_protocol in range(bit_count):
-            self.set_parity_input_by_message_role(round_of_protocol)
-            self.debug_print_protocols(f"      Executing parity protocol for bit {round_of_protocol + 1}/{bit_count}")
-            self.execute_parity()
-            self.add_to_received_message(round_of_protocol)
+        self.debug_print_protocols(f"      Executing vector parity protocol for all {bit_count} bits")
+        self.execute_vector_parity(bit_count)
+        self.add_to_received_message()
 
         self.debug_print_protocols(
             f"      Received amdc encoded message is: {self.message_amdc_encoded_received_message}")
@@ -165,7 +282,7 @@ class ParticipantNode(Node):
                 self.veto_input = 0
         else:
             self.veto_input = 0
-            self.message_amdc_decoded_received_message = self.message_amdc_encoded_received_message
+            self.message_amdc_decoded_received_message = self.message_amdc_encoded_received_message.copy()
 
         self.execute_veto(security)
 
@@ -177,53 +294,44 @@ class ParticipantNode(Node):
         self.send_fixed_message_finished()
         self.debug_print_protocols(f"   ----------Finished fixed role message transmission----------\n")
 
-    def set_parity_input_by_message_role(self, round_of_protocol) -> None:
-        """
-        | Sets parity input by message role
-        | if node is message sender: parity input is a bit from amdc encoded message
-        | if node is message receiver: parity input is a bit from one time pad
-
-        :param round_of_protocol: which round of fixed message transmission it is - index of used message / one time pad
-        """
-        if self.is_message_sender:
-            self.parity_input = self.message_amdc_encoded_input[round_of_protocol]
-        elif self.is_message_receiver:
-            self.parity_input = self.one_time_pad[round_of_protocol]
-
     def create_one_time_pad(self, bit_count) -> None:
         """
         creates a one time pad
         :param bit_count: length of the one time pad
         """
         if self.is_message_receiver:
-            self.one_time_pad = [randbits(1) for _ in range(bit_count)]
+            self.one_time_pad = self.take_random_bits(bit_count)
 
-    def add_to_received_message(self, round_of_protocol) -> None:
+    def add_to_received_message(self) -> None:
         """
-        | decodes message bit by xor'ing with used one time pad key
-        | just for transparency every other participant also adds their received bit to received_message
-        :param round_of_protocol: index of used one time pad bit
+        | decodes message by xor'ing the parity result vector with the used one time pad
+        | just for transparency every other participant also sets received_message to the parity result vector
         """
+        # Every transmission gets a new array, so the results of a previous transmission are not overwritten
         if self.is_message_receiver:
-            self.message_amdc_encoded_received_message.append(self.parity_result ^ self.one_time_pad[round_of_protocol])
+            self.message_amdc_encoded_received_message = np.bitwise_xor(self.parity_result_vector, self.one_time_pad)
         else:
-            self.message_amdc_encoded_received_message.append(self.parity_result)
+            self.message_amdc_encoded_received_message = self.parity_result_vector.copy()
 
     def send_fixed_message_finished(self):
         """
         Participant waits until every other participant is also finished with message transmission protocol
         """
         self.send_to_nodes({"fixed_message_finished": True})
-        self.wait_while_receiving(self.fixed_message_finished, len(self.all_nodes))
-        self.fixed_message_finished = []
+        self.wait_while_receiving(self.fixed_message_finished, self.number_of_peers)
+        self.fixed_message_finished.clear()
 
     def received_message_to_string(self) -> None:
         """
         converts amdc decoded received message from a list of bits (8-bit ascii encoded) to a string of characters
         """
-        list_to_str = "".join(str(i) for i in self.message_amdc_decoded_received_message)
-        self.message_received_str = (
-            "".join([chr(int(i, 2)) for i in [list_to_str[i:i + 8] for i in range(0, len(list_to_str), 8)]]))
+        received_bits = np.asarray(self.message_amdc_decoded_received_message, dtype=np.uint8)
+        received_bytes = np.packbits(received_bits)
+        remaining_bits = len(received_bits) % 8
+        if remaining_bits:
+            # packbits fills up the last byte with zeros on the right, the last chunk is the number of its bits alone
+            received_bytes[-1] >>= 8 - remaining_bits
+        self.message_received_str = received_bytes.tobytes().decode("latin-1")
 
     # Notification
     def execute_notification(self, notification_security: int) -> None:
@@ -244,68 +352,73 @@ class ParticipantNode(Node):
 
     def execute_notification_parity(self, notification_security: int) -> None:
         """
-        Executes notification parity
+        Executes the notification parity rounds of all spectators at once. Every round is an independent parity
+        protocol, but all keys and the results for one spectator are sent as a single message.
 
         :param notification_security: protocol succeeds with probability of at least 1-2**-security
         """
-        for p, parity_round in itertools.product(self.all_node_ids, range(1, notification_security + 1)):
-            self.debug_print_protocols(f"      ----------Starting notification parity round {parity_round} - "
-                                       f"Spectator is Participant {p}")
-            self.set_notification_parity_by_notification_input(p)
-
-            self.distribute_key_bits()
-            self.debug_print_protocols(f"         All keys exchanged: {self.parity_shared_keys}")
-
-            parity_key_xor_result = self.calculate_parity_xor_key_result()
-            self.debug_print_protocols(f"         Calculated parity key xor result: {parity_key_xor_result}")
-
-            if p == self.node_id:
-                self.wait_while_receiving(self.parity_received_broadcast_values, len(self.all_nodes))
-                self.parity_received_broadcast_values.append(parity_key_xor_result)
-                self.debug_print_protocols(f"         Spectator received all broadcasts "
-                                           f"{self.parity_received_broadcast_values}")
-                self.calculate_parity_result()
-                self.set_notification_result_by_parity_result()
-            else:
-                self.send_to_node_by_id(p, {"parity_key_xor_result": parity_key_xor_result})
-                self.debug_print_protocols(f"         Non-spectator did nothing")
-
-            self.parity_shared_keys = []
-            self.parity_received_broadcast_values = []
-            self.parity_input = 0
-            self.send_parity_finished()
-            self.parity_finished = []
-
-    def set_notification_parity_by_notification_input(self, p: str) -> None:
-        """
-        If participant wants to notify the spectator of the round, he sets his parity input bit to 1 with a 50% chance
-        :param p: node_id of the participant, who doesn't broadcast his result and acts as a spectator
-        """
-        if p == self.notification_input:
-            self.parity_input = randbits(1)
+        if not self.node_id_index:
+            # The rounds of the spectators are assigned by the order, which fresh participants have not created yet
+            self.create_order_in_all_node_ids()
+        number_of_participants = len(self.all_node_ids)
+        if self.print_protocols:
+            self.debug_print_protocols(f"      ----------Starting {notification_security} notification parity rounds "
+                                       f"for each of the {number_of_participants} spectators")
+        self.set_notification_parity_by_notification_input(notification_security)
+
+        self.distribute_key_vectors()
+        parity_key_xor_results = np.unpackbits(self.calculate_parity_xor_key_vector())
+        self.parity_shared_key_vectors.clear()
+        parity_key_xor_results = parity_key_xor_results[:number_of_participants * notification_security].reshape(
+            number_of_participants, notification_security)
+        if self.print_protocols:
+            self.debug_print_protocols(f"         Calculated parity key xor results: {parity_key_xor_results.tolist()}")
+
+        for p, i in self.node_id_index.items():
+            if p != self.node_id:
+                self.send_to_node_by_id(p, {"parity_key_xor_result_vector": np.packbits(parity_key_xor_results[i])})
+
+        self.wait_while_receiving(self.parity_received_broadcast_vectors, self.number_of_peers)
+        own_results = np.packbits(parity_key_xor_results[self.node_id_index[self.node_id]])
+        packed_results = np.bitwise_xor.reduce([own_results, *self.parity_received_broadcast_vectors], axis=0)
+        self.parity_result_vector = np.unpackbits(packed_results)[:notification_security]
+        self.set_notification_result_by_parity_result()
+        self.parity_received_broadcast_vectors.clear()
+
+    def set_notification_parity_by_notification_input(self, notification_security: int) -> None:
+        """
+        Sets a parity input bit for every round of every spectator. If participant wants to notify the spectator, he
+        sets the parity input bits of the spectators rounds to 1 with a 50% chance, all other bits are 0
+        :param notification_security: number of rounds for every spectator
+        """
+        parity_inputs = np.zeros((len(self.all_node_ids), notification_security), dtype=np.uint8)
+        if self.notification_input in self.node_id_index:
+            parity_inputs[self.node_id_index[self.notification_input]] = self.take_random_bits(notification_security)
             self.debug_print_protocols(
-                f"      Participant sets parity_input by chance, because he wants to notify the spectator")
-        else:
-            self.parity_input = 0
-        self.debug_print_protocols(
-            f"      Notification Input = {self.notification_input} -> Parity Input = {self.parity_input}")
+                f"      Participant sets parity inputs by chance, because he wants to notify a spectator")
+        self.parity_input_vector = parity_inputs.reshape(-1)
+        if self.print_protocols:
+            self.debug_print_protocols(
+                f"      Notification Input = {self.notification_input} -> Parity Inputs = {parity_inputs.tolist()}")
 
     def set_notification_result_by_parity_result(self) -> None:
         """
-        if parity_result is 0, notification result stays the same;
-        if parity_result is 1, notification result gets set to 1
+        if all parity results of the spectators rounds are 0, notification result stays the same;
+        if a parity result is 1, notification result gets set to 1
         """
-        self.notification_result = self.notification_result | self.parity_result
-        self.debug_print_protocols(f"         Spectator calculated parity result {self.parity_result}")
-        self.debug_print_protocols(f"         Spectator notification result is {self.notification_result}")
+        self.notification_result = self.notification_result | int(self.parity_result_vector.any())
+        if self.print_protocols:
+            self.debug_print_protocols(
+                f"         Spectator calculated parity results {self.parity_result_vector.tolist()}")
+            self.debug_print_protocols(f"         Spectator notification result is {self.notification_result}")
 
     def send_notification_finished(self) -> None:
         """
         Participant waits until every other participant is also finished with notification protocol
         """
         self.send_to_nodes({"notification_finished": True})
-        self.wait_while_receiving(self.notification_finished, len(self.all_nodes))
-        self.notification_finished = []
+        self.wait_while_receiving(self.notification_finished, self.number_of_peers)
+        self.notification_finished.clear()
 
     # Collision Detection
     def execute_collision_detection(self, collision_detection_security: int) -> None:
@@ -359,8 +472,8 @@ class ParticipantNode(Node):
         Participant waits until every other participant is also finished with collision detection protocol
         """
         self.send_to_nodes({"collision_detection_finished": True})
-        self.wait_while_receiving(self.collision_detection_finished, len(self.all_nodes))
-        self.collision_detection_finished = []
+        self.wait_while_receiving(self.collision_detection_finished, self.number_of_peers)
+        self.collision_detection_finished.clear()
 
     # Veto
     def execute_veto(self, veto_security: int) -> None:
@@ -369,25 +482,33 @@ class ParticipantNode(Node):
 
         :param veto_security: protocol succeeds with probability of at least 1-2**-security
         """
+        assert self.veto_input in (0, 1), f"Bit should be 1 or 0, is {self.veto_input}"
         self.debug_print_protocols(f"      ----------Executing Veto----------")
+        piggyback_message = None
         for last_broadcaster in self.all_node_ids:
             if last_broadcaster == self.node_id:
                 self.parity_broadcasts_last = True
-            self.debug_print_protocols(f"      Broadcasts last is {self.parity_broadcasts_last}")
+            if self.print_protocols:
+                self.debug_print_protocols(f"      Broadcasts last is {self.parity_broadcasts_last}")
             for i in range(1, veto_security + 1):
-                self.debug_print_protocols(
-                    f"      Veto Round {self.all_node_ids.index(last_broadcaster) + 1}-{i} started")
+                if self.print_protocols:
+                    self.debug_print_protocols(
+                        f"      Veto Round {self.node_id_index[last_broadcaster] + 1}-{i} started")
                 self.set_parity_input_by_veto_input()
-                self.execute_parity()
+                if last_broadcaster == self.all_node_ids[-1] and i == veto_security:
+                    # veto finishes with this round, so veto_finished is sent together with the broadcast
+                    piggyback_message = {"veto_finished": True}
+                self.execute_parity(piggyback_message)
                 self.veto_result = self.parity_result
                 if self.veto_result == 1:
                     self.parity_broadcasts_last = False
-                    self.send_veto_finished()
+                    self.send_veto_finished(send_message=piggyback_message is None)
                     self.debug_print_protocols(f"      ----------Veto abort - Parity Result was 1----------")
                     return
             self.parity_broadcasts_last = False
-        self.send_veto_finished()
-        self.debug_print_protocols(f"      ----------Veto finished - Veto result = {self.veto_result}----------")
+        self.send_veto_finished(send_message=piggyback_message is None)
+        if self.print_protocols:
+            self.debug_print_protocols(f"      ----------Veto finished - Veto result = {self.veto_result}----------")
 
     def set_parity_input_by_veto_input(self) -> None:
         """
@@ -396,48 +517,54 @@ class ParticipantNode(Node):
         if self.veto_input == 0:
             self.parity_input = 0
         else:
-            self.parity_input = randbits(1)
-        self.debug_print_protocols(f"      Veto Input = {self.veto_input} -> Parity Input = {self.parity_input}")
+            self.parity_input = int(self.take_random_bits(1)[0])
+        if self.print_protocols:
+            self.debug_print_protocols(f"      Veto Input = {self.veto_input} -> Parity Input = {self.parity_input}")
 
-    def send_veto_finished(self) -> None:
+    def send_veto_finished(self, send_message: bool = True) -> None:
         """
         Participant waits until every other participant is also finished with veto protocol
+        :param send_message: False if veto_finished has already been sent with the last parity broadcast
         """
-        self.send_to_nodes({"veto_finished": True})
-        self.wait_while_receiving(self.veto_finished, len(self.all_nodes))
-        self.veto_finished = []
+        if send_message:
+            self.send_to_nodes({"veto_finished": True})
+        self.wait_while_receiving(self.veto_finished, self.number_of_peers)
+        self.veto_finished.clear()
 
     # Parity
-    def execute_parity(self) -> None:
+    def execute_parity(self, piggyback_message: dict = None) -> None:
         """
         Executes parity protocol
+        :param piggyback_message: message that is sent to all nodes together with the broadcast
         """
-        self.debug_print_protocols("         ----------Starting Parity----------")
-        self.debug_print_protocols(f"         Parity Input is {self.parity_input}")
+        assert self.parity_input in (0, 1), f"Bit should be 1 or 0, is {self.parity_input}"
+        if self.print_protocols:
+            self.debug_print_protocols("         ----------Starting Parity----------")
+            self.debug_print_protocols(f"         Parity Input is {self.parity_input}")
 
         self.distribute_key_bits()
-        self.debug_print_protocols(f"         All keys exchanged: {self.parity_shared_keys}")
+        if self.print_protocols:
+            self.debug_print_protocols(f"         All keys exchanged: {self.parity_shared_keys}")
 
-        self.calculate_and_broadcast_keys()
-        self.debug_print_protocols(f"         Broadcasting finished: {self.parity_received_broadcast_values}")
+        self.calculate_and_broadcast_keys(piggyback_message)
+        if self.print_protocols:
+            self.debug_print_protocols(f"         Broadcasting finished: {self.parity_received_broadcast_values}")
 
         self.calculate_parity_result()
-        self.debug_print_protocols(f"         Calculated parity result: {self.parity_result}")
-
-        self.parity_shared_keys = []
-        self.parity_received_broadcast_values = []
+        if self.print_protocols:
+            self.debug_print_protocols(f"         Calculated parity result: {self.parity_result}")
 
-        self.send_parity_finished()
+        with self.message_sorted:
+            self.parity_received_broadcast_values.clear()
         self.debug_print_protocols(f"         ----------Finished parity----------")
 
     def create_bitstring(self) -> list[int]:
         """
-        Creates bitstring with length all_nodes + 1, which should be the number of all participants in the network
+        Creates bitstring with length all_nodes + 1, which should be the number of all participants in the network.
+        All bits but the last are random, the last bit is chosen so the parity of the bitstring is parity_input
         """
-        number_of_participants = len(self.all_nodes) + 1
-        bitstring = [randbits(1) for _ in range(number_of_participants)]
-        while bitstring.count(1) % 2 != self.parity_input:
-            bitstring = [randbits(1) for _ in range(number_of_participants)]
+        bitstring = self.take_random_bits(self.number_of_peers).tolist()
+        bitstring.append(sum(bitstring) % 2 ^ self.parity_input)
         return bitstring
 
     def distribute_key_bits(self) -> None:
@@ -445,82 +572,143 @@ class ParticipantNode(Node):
         Creates bitstring, adds first bit to own shared_keys list, distributes the rest to other nodes
         """
         bitstring = self.create_bitstring()
-        self.debug_print_protocols(f"         Created bitstring {bitstring}")
-        self.parity_shared_keys.append(bitstring.pop(0))
+        if self.print_protocols:
+            self.debug_print_protocols(f"         Created bitstring {bitstring}")
+        with self.message_sorted:
+            self.parity_shared_keys.append(bitstring.pop(0))
         for n in self.all_nodes:
             self.send_to_node(n, {"parity_shared_key": bitstring.pop(0)})
-        self.wait_while_receiving(self.parity_shared_keys, len(self.all_nodes) + 1)
+        self.wait_while_receiving(self.parity_shared_keys, self.number_of_peers + 1)
 
-    def calculate_and_broadcast_keys(self) -> None:
+    def calculate_and_broadcast_keys(self, piggyback_message: dict = None) -> None:
         """
         | Calculates parity of all shared keys and broadcasts it to other nodes
         | If broadcasts_last is set to True participants waits till everyone broadcast till he broadcasts his bit
+        :param piggyback_message: message that is sent to all nodes together with the broadcast
         """
         parity_key_xor_result = self.calculate_parity_xor_key_result()
-        self.debug_print_protocols(f"         Calculated parity key xor result: {parity_key_xor_result}")
+        if self.print_protocols:
+            self.debug_print_protocols(f"         Calculated parity key xor result: {parity_key_xor_result}")
+        # Other participants can only send keys for the next round after receiving this broadcast, so the keys are
+        # cleared before broadcasting and no barrier is needed between two rounds
+        with self.message_sorted:
+            self.parity_shared_keys.clear()
 
         if self.parity_broadcasts_last:
-            self.wait_while_receiving(self.parity_received_broadcast_values, len(self.all_nodes))
+            self.wait_while_receiving(self.parity_received_broadcast_values, self.number_of_peers)
             self.send_to_nodes({"parity_key_xor_result": parity_key_xor_result})
+            if piggyback_message is not None:
+                self.send_to_nodes(piggyback_message)
             self.debug_print_protocols(f"         Sent his xor result last")
         else:
             self.send_to_nodes({"parity_key_xor_result": parity_key_xor_result})
-            self.wait_while_receiving(self.parity_received_broadcast_values, len(self.all_nodes))
-        self.parity_received_broadcast_values.append(parity_key_xor_result)
+            if piggyback_message is not None:
+                self.send_to_nodes(piggyback_message)
+            self.wait_while_receiving(self.parity_received_broadcast_values, self.number_of_peers)
+        with self.message_sorted:
+            self.parity_received_broadcast_values.append(parity_key_xor_result)
 
     def calculate_parity_xor_key_result(self) -> int:
         """
         Participant calculates the bit he wants to broadcast by xor'ing all received shared keys and his own parity bit
         :return: xor value of parity_shared_keys
         """
-        return int(np.bitwise_xor.reduce(self.parity_shared_keys))
+        return int(np.bitwise_xor.reduce(self.parity_shared_keys.values()))
 
     def calculate_parity_result(self) -> None:
         """
         Participant calculates parity result by xor'ing all received broadcast values and his own calculated xor_result
         """
-        self.parity_result = np.bitwise_xor.reduce(self.parity_received_broadcast_values)
+        self.parity_result = int(np.bitwise_xor.reduce(self.parity_received_broadcast_values.values()))
 
-    def send_parity_finished(self) -> None:
+    # Vector parity
+    def execute_vector_parity(self, bit_count: int) -> None:
         """
-        Participant waits until every other participant is also finished with parity protocol
+        Executes bit_count independent parity protocols at once. Every participant sends all his keys to another
+        participant and his broadcast as a single message, so the network round trips are the same as for one bit.
+
+        Prerequisites:
+            * parity_input_vector has to be set, with length bit_count
+        :param bit_count: the amount of bits in parity_input_vector
         """
-        self.send_to_nodes({"parity_finished": True})
-        self.wait_while_receiving(self.parity_finished, len(self.all_nodes))
-        self.parity_finished = []
+        if self.print_protocols:
+            self.debug_print_protocols("         ----------Starting Vector Parity----------")
+            self.debug_print_protocols(f"         Parity Input Vector is {self.parity_input_vector.tolist()}")
 
-    # Getter / Setter
-    # TODO remove all getter setter if program is finished and only message transmission should be available
-    @property
-    def parity_input(self):
-        return self._parity_input
+        self.distribute_key_vectors()
+        self.calculate_and_broadcast_key_vectors()
 
-    @parity_input.setter
-    def parity_input(self, bit):
-        if bit != 1 and bit != 0:
-            raise ValueError(f"Bit should be 1 or 0, is {bit}")
-        self._parity_input = bit
+        packed_result = np.bitwise_xor.reduce(self.parity_received_broadcast_vectors, axis=0)
+        self.parity_result_vector = np.unpackbits(packed_result)[:bit_count]
+        if self.print_protocols:
+            self.debug_print_protocols(
+                f"         Calculated parity result vector: {self.parity_result_vector.tolist()}")
 
-    @property
-    def veto_input(self):
-        return self._veto_input
+        self.parity_received_broadcast_vectors.clear()
+        self.debug_print_protocols(f"         ----------Finished vector parity----------")
 
-    @veto_input.setter
-    def veto_input(self, bit):
-        if bit != 1 and bit != 0:
-            raise ValueError(f"Bit should be 1 or 0, is {bit}")
-        self._veto_input = bit
+    def create_bitstring_matrix(self) -> np.ndarray:
+        """
+        Creates one packed bitstring per participant, so that the xor of all rows is the packed parity_input_vector.
+        Row 0 is the own key, row i is the key for the i-th node in all_nodes
+        """
+        packed_input = np.packbits(self.parity_input_vector)
+        number_of_participants = self.number_of_peers + 1
+        bitstring_matrix = np.frombuffer(token_bytes(number_of_participants * len(packed_input)), dtype=np.uint8)
+        bitstring_matrix = bitstring_matrix.reshape(number_of_participants, len(packed_input)).copy()
+        bitstring_matrix[0] = packed_input ^ np.bitwise_xor.reduce(bitstring_matrix[1:], axis=0)
+        return bitstring_matrix
 
-    @property
-    def collision_detection_input(self):
-        return self._collision_detection_input
+    def distribute_key_vectors(self) -> None:
+        """
+        Creates bitstring matrix, adds first row to own shared_key_vectors, distributes the other rows to other nodes
+        """
+        bitstring_matrix = self.create_bitstring_matrix()
+        self.parity_shared_key_vectors.append(bitstring_matrix[0])
+        for n, key_vector in zip(self.all_nodes, bitstring_matrix[1:]):
+            self.send_to_node(n, {"parity_shared_key_vector": key_vector})
+        self.wait_while_receiving(self.parity_shared_key_vectors, self.number_of_peers + 1)
+
+    def calculate_and_broadcast_key_vectors(self) -> None:
+        """
+        | Calculates parity of all shared key vectors and broadcasts it to other nodes
+        | If broadcasts_last is set to True participants waits till everyone broadcast till he broadcasts his vector
+        """
+        parity_key_xor_result = self.calculate_parity_xor_key_vector()
+        self.parity_shared_key_vectors.clear()  # Cleared before broadcasting, like in calculate_and_broadcast_keys
+        message = {"parity_key_xor_result_vector": parity_key_xor_result}
+
+        if self.parity_broadcasts_last:
+            self.wait_while_receiving(self.parity_received_broadcast_vectors, self.number_of_peers)
+            self.send_to_nodes(message)
+        else:
+            self.send_to_nodes(message)
+            self.wait_while_receiving(self.parity_received_broadcast_vectors, self.number_of_peers)
+        self.parity_received_broadcast_vectors.append(parity_key_xor_result)
+
+    def calculate_parity_xor_key_vector(self) -> np.ndarray:
+        """
+        Participant calculates the packed vector he wants to broadcast by xor'ing all received shared key vectors
+        :return: xor value of parity_shared_key_vectors
+        """
+        return np.bitwise_xor.reduce(self.parity_shared_key_vectors, axis=0)
 
-    @collision_detection_input.setter
-    def collision_detection_input(self, bit):
-        if bit != 1 and bit != 0:
-            raise ValueError(f"Bit should be 1 or 0, is {bit}")
-        self._collision_detection_input = bit
+    def take_random_bits(self, count: int) -> np.ndarray:
+        """
+        Takes random bits from the random bit pool, every bit is only used once
+        :param count: number of random bits
+        :return: uint8 array with the random bits
+        """
+        if self.random_bit_offset + count > len(self.random_bit_pool):
+            random_bytes = token_bytes(max(self.RANDOM_POOL_BYTES, (count + 7) // 8))
+            self.random_bit_pool = np.unpackbits(np.frombuffer(random_bytes, dtype=np.uint8))
+            self.random_bit_offset = 0
+        random_bits = self.random_bit_pool[self.random_bit_offset:self.random_bit_offset + count]
+        self.random_bit_offset += count
+        return random_bits
 
+    # Getter / Setter
+    # TODO remove all getter setter if program is finished and only message transmission should be available
     @property
     def notification_input(self):
         return self._notification_input
@@ -543,7 +731,8 @@ class ParticipantNode(Node):
             raise IndexError(f"Maximum message length: {self.message_length / 8} characters")
         else:
             padded_message = message.ljust(int(self.message_length / 8))
-            self._message_input = list(map(int, "".join(format(ord(i), '08b') for i in padded_message)))
+            message_bytes = np.frombuffer(padded_message.encode("latin-1"), dtype=np.uint8)
+            self._message_input = np.unpackbits(message_bytes).tolist()
             self.debug_print_protocols(f"Converting input to 8 bit ascii: {self._message_input}")
 
     # Utility methods
@@ -555,91 +744,82 @@ class ParticipantNode(Node):
         """
         self.debug_print_protocols("Creating order in all_node_ids")
         self.send_to_nodes({"node_id": self.node_id})
-        self.wait_while_receiving(self.all_node_ids, len(self.all_nodes))
+        self.wait_while_receiving(self.all_node_ids, self.number_of_peers)
         if self.node_id in self.all_node_ids:
             raise NameError("Two Nodes have the same node_id")
         self.all_node_ids.append(self.node_id)
         self.all_node_ids.sort()
+        self.node_id_index = {node_id: i for i, node_id in enumerate(self.all_node_ids)}
         self.debug_print_protocols(f"Order is {self.all_node_ids}")
 
-    @staticmethod
-    def wait_while_receiving(element_list: list, amount_of_elements: int) -> None:
+    def wait_while_receiving(self, element_list: list, amount_of_elements: int) -> None:
         """
-        Waits until *element_list* has *amount_of_elements* in it
+        Sends all pending messages and waits until *element_list* has *amount_of_elements* in it
         :param element_list:
         :param amount_of_elements:
+        :raise ConnectionError: if a participant disconnected while waiting, its message would never arrive
         """
-        while len(element_list) != amount_of_elements:
-            # TODO time.sleep could be variable..
-            #  If there are more participants it could be higher to minimize processor load
-            #  If there are less participants it could be lower to minimize latency
-            time.sleep(0.01)
-            pass
+        self.flush()
+        number_of_peers = self.number_of_peers
+        with self.message_sorted:
+            self.message_sorted.wait_for(
+                lambda: len(element_list) == amount_of_elements or self.number_of_peers < number_of_peers)
+            if len(element_list) != amount_of_elements:
+                raise ConnectionError(f"{self.node_id}: A participant disconnected, received {len(element_list)} of "
+                                      f"{amount_of_elements} messages")
 
-    def sort_incoming_messages(self, message: dict) -> None:
+    def sort_incoming_messages(self, message: bytes) -> None:
         """
         Sorts messages the node received and appends them to the corresponding lists
 
-        :param message: message received from other nodes
+        :param message: message received from other nodes, encoded by encode_message
         :raise LookupError:
         """
-        (protocol, value), = message.items()
-        match protocol:
-            case "node_id":
-                self.all_node_ids.append(value)
-            case "parity_shared_key":
-                self.parity_shared_keys.append(value)
-            case "parity_key_xor_result":
-                self.parity_received_broadcast_values.append(value)
-            case "parity_finished":
-                self.parity_finished.append(value)
-            case "veto_finished":
-                self.veto_finished.append(value)
-            case "collision_detection_finished":
-                self.collision_detection_finished.append(value)
-            case "notification_finished":
-                self.notification_finished.append(value)
-            case "fixed_message_finished":
-                self.fixed_message_finished.append(value)
-            case "message_finished":
-                self.message_finished.append(value)
-            case _:
-                raise LookupError(f"Can't match message protocol - {message}")
+        protocol, value = self.decode_message(message)
+        with self.message_sorted:
+            self.message_handlers[protocol](value)
+            self.message_sorted.notify_all()
 
     def clear_all(self) -> None:
         """
         Resets all the class variables to their original state
         """
-        self.all_node_ids = []
+        self.all_node_ids.clear()
+        self.node_id_index = {}
 
         self.parity_input = 0
-        self.parity_shared_keys = []
+        self.parity_shared_keys.clear()
         self.parity_broadcasts_last = False
-        self.parity_received_broadcast_values = []
+        self.parity_received_broadcast_values.clear()
         self.parity_result = 0
-        self.parity_finished = []
+
+        self.parity_input_vector = np.zeros(0, dtype=np.uint8)
+        self.parity_shared_key_vectors.clear()
+        self.parity_received_broadcast_vectors.clear()
+        self.parity_result_vector = np.zeros(0, dtype=np.uint8)
 
         self.veto_input = 0
         self.veto_result = 0
-        self.veto_finished = []
+        self.veto_finished.clear()
 
         self.collision_detection_input = 0
         self.collision_detection_result = 0
-        self.collision_detection_finished = []
+        self.collision_detection_finished.clear()
 
         self.notification_input = ""
         self.notification_is_spectator = False
         self.notification_result = 0
-        self.notification_finished = []
+        self.notification_finished.clear()
 
         self.message_input = []
         self.is_message_sender = False
         self.is_message_receiver = False
         self.message_amdc_encoded_input = []
-        self.message_amdc_encoded_received_message = []
+        self.message_amdc_encoded_future = None
+        self.message_amdc_encoded_received_message = np.zeros(self.encoded_message_length, dtype=np.uint8)
         self.message_amdc_decoded_received_message = []
-        self.one_time_pad = []
-        self.fixed_message_finished = []
+        self.one_time_pad = np.zeros(0, dtype=np.uint8)
+        self.fixed_message_finished.clear()
 
     def debug_print_protocols(self, message: str) -> None:
         """
@@ -649,7 +829,115 @@ class ParticipantNode(Node):
         if self.print_protocols is True:
             print(f"{self.node_id}: {message}")
 
+    # Coalesced sending
+    def send_to_nodes(self, data, exclude=None) -> None:
+        """
+        Queues the message for all connected nodes, it is sent with the next flush
+        :param data: message for the nodes
+        :param exclude: nodes the message should not be sent to
+        """
+        exclude = set(exclude) if exclude else set()
+        encoded_message = self.encode_message(data)
+        with self.pending_messages_lock:
+            for n in self.all_nodes:
+                if n not in exclude:
+                    self.pending_messages.setdefault(n, []).append(encoded_message)
+
+    def send_to_node(self, n, data) -> None:
+        """
+        Queues the message for node n, it is sent with the next flush
+        :param n: node connection the message is for
+        :param data: message for the node
+        """
+        encoded_message = self.encode_message(data)
+        with self.pending_messages_lock:
+            self.pending_messages.setdefault(n, []).append(encoded_message)
+
+    def send_to_node_by_id(self, receiver_id, data) -> None:
+        """
+        Queues the message for the node with node_id receiver_id, it is sent with the next flush
+        :param receiver_id: node_id of the node the message is for
+        :param data: message for the node
+        """
+        receiver_id = str(receiver_id)
+        with self.peers_lock:
+            n = self.nodes_inbound.get(receiver_id) or self.nodes_outbound.get(receiver_id)
+        if n is not None:
+            self.send_to_node(n, data)
+        else:
+            self.debug_print_network("ParticipantNode send_to_node_by_id: Could not send the data, node is not found!")
+
+    @classmethod
+    def encode_message(cls, message: dict) -> bytes:
+        """
+        Encodes a message {protocol: value} as the tag of the protocol followed by the value in bytes
+        :param message: dict with a single protocol and its value
+        :return: encoded message
+        """
+        (protocol, value), = message.items()
+        if isinstance(value, str):
+            payload = value.encode("utf-8")
+        elif isinstance(value, np.ndarray):
+            payload = value.tobytes()
+        else:
+            payload = bytes((int(value),))  # bits and finished flags
+        return bytes((cls.MESSAGE_TAGS[protocol],)) + payload
+
+    @staticmethod
+    def decode_message(message: bytes) -> tuple:
+        """
+        Decodes a message encoded by encode_message
+        :param message: encoded message
+        :return: protocol and value of the message
+        :raise LookupError:
+        """
+        if not message or message[0] >= len(MESSAGE_PROTOCOLS):
+            raise LookupError(f"Can't match message protocol - {message}")
+        protocol, decode_value = MESSAGE_PROTOCOLS[message[0]]
+        return protocol, decode_value(message[1:])
+
+    def flush(self) -> None:
+        """
+        Sends all queued messages of a node connection as a single batch packet, which is split up again into the single
+        messages by the receiving node. Node connections with the same queued messages, like after a broadcast, share
+        the encoded packet
+        """
+        with self.pending_messages_lock:
+            pending_messages = self.pending_messages
+            self.pending_messages = {}
+
+        packets = {}
+        for n, messages in pending_messages.items():
+            messages = tuple(messages)
+            packet = packets.get(messages)
+            if packet is None:
+                packet = NodeConnection.encode_batch_packet([NodeConnection.encode_batch_item(m) for m in messages])
+                packets[messages] = packet
+            self.message_count_sent = self.message_count_sent + 1
+            n.send_raw(packet)
+
     # override network methods
+    def stop(self):
+        super(ParticipantNode, self).stop()
+        self.encode_worker.shutdown(wait=False)
+
+    def update_peer_snapshot(self):
+        super(ParticipantNode, self).update_peer_snapshot()
+        self.number_of_peers = len(self.peer_snapshot)
+        self.peers_changed.notify_all()
+        with self.message_sorted:
+            self.message_sorted.notify_all()  # A protocol waiting for the messages of a lost participant fails
+
+    def wait_for_peers(self, number_of_peers: int, timeout: float = None) -> bool:
+        """
+        Blocks until the participant is connected with at least *number_of_peers* other participants
+        :param number_of_peers: number of connected participants to wait for
+        :param timeout: maximum time to wait in seconds, None waits until enough participants are connected
+        :return: True if enough participants are connected, False if the timeout expired
+        """
+        with self.peers_changed:
+            return self.peers_changed.wait_for(lambda: self.number_of_peers >= number_of_peers, timeout)
+
     def outbound_node_connected(self, node):
         # print(f"{self.node_id} connected to {node.connected_node_id}")
         pass
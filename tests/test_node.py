@@ -0,0 +1,66 @@
+import random
+import socket
+import threading
+import time
+import unittest
+from p2p_network.node import Node
+
+
+class SilentPeer:
+    """
+    Peer that answers the handshake and afterwards never receives any data
+    """
+    def __init__(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("localhost", 0))
+        self.server.listen()
+        self.port = self.server.getsockname()[1]
+        self.connection = None
+        self.thread = threading.Thread(target=self.accept, daemon=True)
+        self.thread.start()
+
+    def accept(self):
+        self.connection, _ = self.server.accept()
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.connection.recv(Node.HANDSHAKE_HEADER.size + 64)
+        handshake = b"silent"
+        self.connection.sendall(Node.HANDSHAKE_HEADER.pack(len(handshake)) + handshake)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.server.close()
+
+
+class TestSendQueue(unittest.TestCase):
+    def setUp(self):
+        self.node = Node("localhost", random.randint(30000, 60000), "node")
+        self.node.start()
+        self.peer = SilentPeer()
+
+    def tearDown(self):
+        self.node.stop()
+        self.node.join()
+        self.peer.close()
+
+    def test_stalled_peer_is_stopped(self):
+        self.assertTrue(self.node.connect_with_node("localhost", self.peer.port))
+        node_connection = self.node.nodes_outbound["silent"]
+        node_connection.MAX_QUEUED_PACKETS = 4
+        node_connection.SEND_QUEUE_TIMEOUT = 0.5
+
+        packet = bytes(1 << 20)
+        start = time.monotonic()
+        while not node_connection.terminate_flag.is_set():
+            self.assertLess(time.monotonic() - start, 10)
+            node_connection.send_raw(packet)
+
+        self.assertEqual(self.node.message_count_error, 1)
+        deadline = time.monotonic() + 5
+        while "silent" in self.node.nodes_outbound:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import random
+import threading
+import unittest
+from p2p_network.participant_node import ParticipantNode
+
+PEER_TIMEOUT = 10
+
+
+def start_participants(number_of_participants):
+    """
+    Starts participants on free ports of localhost and connects every participant with all other participants
+    :param number_of_participants: number of participants to start
+    :return: list of the started participants, their node_ids are 1 to number_of_participants
+    """
+    base_port = random.randint(30000, 60000 - number_of_participants)
+    participants = [ParticipantNode("localhost", base_port + i, str(i)) for i in range(1, number_of_participants + 1)]
+    for participant in participants:
+        participant.start()
+    for index, participant in enumerate(participants):
+        for other in participants[:index]:
+            participant.connect_with_node("localhost", other.port)
+    for participant in participants:
+        if not participant.wait_for_peers(number_of_participants - 1, timeout=PEER_TIMEOUT):
+            raise TimeoutError(f"{participant.node_id} is not connected with all participants")
+    return participants
+
+
+def stop_participants(participants):
+    for participant in participants:
+        participant.stop()
+    for participant in participants:
+        participant.join()
+
+
+def execute_on_all(participants, method, *args):
+    """
+    Executes the protocol method on all participants at the same time and waits until all are finished
+    :param participants: participants that execute the protocol
+    :param method: name of the ParticipantNode method
+    :param args: arguments of the method
+    """
+    threads = [threading.Thread(target=getattr(participant, method), args=args, daemon=True)
+               for participant in participants]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(PEER_TIMEOUT)
+        if thread.is_alive():
+            raise TimeoutError(f"{method} did not finish")
+
+
+class TestReceivedMessageToString(unittest.TestCase):
+    def setUp(self):
+        self.participants = start_participants(1)
+        self.participant = self.participants[0]
+
+    def tearDown(self):
+        stop_participants(self.participants)
+
+    def test_whole_bytes(self):
+        self.participant.message_amdc_decoded_received_message = [0, 1, 0, 0, 1, 0, 0, 0, 0, 1, 1, 0, 1, 0, 0, 1]
+        self.participant.received_message_to_string()
+        self.assertEqual(self.participant.message_received_str, "Hi")
+
+    def test_partial_last_byte(self):
+        bits = [random.randint(0, 1) for _ in range(99)]
+        bit_str = "".join(str(bit) for bit in bits)
+        expected = "".join(chr(int(bit_str[i:i + 8], 2)) for i in range(0, len(bit_str), 8))
+        self.participant.message_amdc_decoded_received_message = bits
+        self.participant.received_message_to_string()
+        self.assertEqual(self.participant.message_received_str, expected)
+
+    def test_partial_only_byte(self):
+        self.participant.message_amdc_decoded_received_message = [1, 0, 1]
+        self.participant.received_message_to_string()
+        self.assertEqual(self.participant.message_received_str, chr(5))
+
+
+class TestWaitWhileReceiving(unittest.TestCase):
+    def setUp(self):
+        self.participants = start_participants(2)
+
+    def tearDown(self):
+        stop_participants(self.participants)
+
+    def test_disconnected_participant(self):
+        errors = []
+
+        def wait():
+            try:
+                self.participants[0].wait_while_receiving(self.participants[0].veto_finished, 1)
+            except ConnectionError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=wait, daemon=True)
+        thread.start()
+        self.participants[1].stop()
+        thread.join(PEER_TIMEOUT)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+
+
+class TestNotification(unittest.TestCase):
+    def setUp(self):
+        self.participants = start_participants(3)
+
+    def tearDown(self):
+        stop_participants(self.participants)
+
+    def test_notification_without_order(self):
+        self.participants[0].notification_input = "2"
+        execute_on_all(self.participants, "execute_notification", 20)
+        self.assertEqual([p.notification_result for p in self.participants], [0, 1, 0])
+
+
+class TestFixedRoleMessageTransmission(unittest.TestCase):
+    def setUp(self):
+        self.participants = start_participants(3)
+        execute_on_all(self.participants, "create_order_in_all_node_ids")
+        self.participants[0].message_input = "Hello 2!"
+        self.participants[0].is_message_sender = True
+        self.participants[1].is_message_receiver = True
+
+    def tearDown(self):
+        stop_participants(self.participants)
+
+    def test_previous_result_is_kept(self):
+        spectator = self.participants[2]
+        execute_on_all(self.participants, "execute_fixed_role_message_transmission", 5, 99)
+        self.assertEqual(self.participants[1].message_received_str, "Hello 2!")
+        first_encoded = spectator.message_amdc_encoded_received_message
+        first_decoded = spectator.message_amdc_decoded_received_message
+        first_encoded_bits = first_encoded.tolist()
+        first_decoded_bits = first_decoded.tolist()
+
+        execute_on_all(self.participants, "execute_fixed_role_message_transmission", 5, 99)
+        self.assertEqual(self.participants[1].message_received_str, "Hello 2!")
+        self.assertEqual(first_encoded.tolist(), first_encoded_bits)
+        self.assertEqual(first_decoded.tolist(), first_decoded_bits)
+        self.assertIsNot(spectator.message_amdc_encoded_received_message, first_encoded)
+
+
+if __name__ == "__main__":
+    unittest.main()
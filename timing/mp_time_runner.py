@@ -0,0 +1,273 @@
+import os
+import pickle
+import timeit
+import sys
+from functools import partial
+from pathlib import Path
+from multiprocessing import Process, Manager, Pipe, RawArray, set_forkserver_preload, set_start_method
+from threading import Barrier, Thread
+import numpy as np
+from p2p_network.participant_node import ParticipantNode
+
+TIMEIT_REPETITION = 1
+PORT = 20000
+LOG_DIR = Path(__file__).parent / "timing_logs"
+PEER_TIMEOUT = 30  # Seconds a participant waits for the connections to all other participants
+WORKER_POLL_INTERVAL = 1  # Seconds between the checks whether the worker processes are still alive
+
+
+class TimedProtocol:
+    """
+    Describes how the timing harness sets up, executes and logs one protocol of the ParticipantNode.
+    """
+
+    def __init__(self, name, execute_method_name, log_name, setup_hook=None, extra_prompts=(), uses_security=True,
+                 security=None, extra_execute_args=(), create_order=True, result_attributes=(),
+                 print_protocol=False):
+        """
+        :param name: name of the protocol, used for the log and the output
+        :param execute_method_name: name of the ParticipantNode method that executes the protocol
+        :param log_name: name of the pickle file in LOG_DIR the results are written to
+        :param setup_hook: function(participant, node_id, *answers) that sets the input of a participant, answers are
+            the answers to extra_prompts
+        :param extra_prompts: prompts asked after the number of participants, datapoints and the security
+        :param uses_security: whether the security is passed to the execute method and logged
+        :param security: fixed security, None asks for it
+        :param extra_execute_args: arguments passed to the execute method after the security
+        :param create_order: whether create_order_in_all_node_ids is executed before the protocol
+        :param result_attributes: attributes of the ParticipantNode that are printed after the protocol
+        :param print_protocol: print_protocols of the ParticipantNode
+        """
+        self.name = name
+        self.execute_method_name = execute_method_name
+        self.log_name = log_name
+        self.setup_hook = setup_hook
+        self.extra_prompts = extra_prompts
+        self.uses_security = uses_security
+        self.security = security
+        self.extra_execute_args = extra_execute_args
+        self.create_order = create_order
+        self.result_attributes = result_attributes
+        self.print_protocol = print_protocol
+
+
+def raise_scheduling_priority(thread_ids):
+    """
+    Switches the threads to the real time scheduler while a protocol is timed, which reduces the scheduling noise in
+    the timings. Threads they start meanwhile keep the normal scheduler (SCHED_RESET_ON_FORK). Needs the CAP_SYS_NICE
+    capability, e.g. root, without it or on platforms without sched_setscheduler the priority is not changed.
+    :param thread_ids: native ids of the threads, 0 is the calling thread
+    :return: threads whose scheduler has been changed, with their previous scheduler and its parameters
+    """
+    previous_scheduling = []
+    for thread_id in thread_ids:
+        try:
+            previous = (thread_id, os.sched_getscheduler(thread_id), os.sched_getparam(thread_id))
+            os.sched_setscheduler(thread_id, os.SCHED_FIFO | os.SCHED_RESET_ON_FORK, os.sched_param(50))
+        except (AttributeError, OSError):
+            continue
+        previous_scheduling.append(previous)
+    return previous_scheduling
+
+
+def restore_scheduling_priority(previous_scheduling):
+    """
+    Restores the scheduler of the threads, which was replaced by raise_scheduling_priority.
+    :param previous_scheduling: return value of raise_scheduling_priority
+    """
+    for thread_id, scheduler, parameters in previous_scheduling:
+        os.sched_setscheduler(thread_id, scheduler, parameters)
+
+
+def create_new_client_instance(node_id, number_of_participants, barrier, debug_protocol, debug_network, shared_results,
+                               protocol, execute_args, answers):
+    new_participant = ParticipantNode("localhost", PORT + node_id, node_id, print_protocols=protocol.print_protocol,
+                                      debug_protocols=debug_protocol)
+    new_participant.start()
+    try:
+        barrier.wait()
+        new_participant.debug = debug_network
+        if protocol.setup_hook is not None:
+            protocol.setup_hook(new_participant, node_id, *answers)
+        for i in range(1, node_id):
+            if not new_participant.connect_with_node("localhost", PORT + int(i)):
+                raise ConnectionError(f"{node_id} could not connect with participant {i}")
+        if not new_participant.wait_for_peers(number_of_participants - 1, timeout=PEER_TIMEOUT):
+            raise TimeoutError(f"{node_id} is connected with {new_participant.number_of_peers} of "
+                               f"{number_of_participants - 1} participants after {PEER_TIMEOUT}s")
+        barrier.wait()
+        if protocol.create_order:
+            print(f"{node_id} starting create_order")
+            new_participant.create_order_in_all_node_ids()
+
+        print(f"{node_id} starting {protocol.name.lower()}")
+
+        # Only the timed protocol runs with the real time priority, the protocol thread sends and the main loop of the
+        # node receives the messages
+        previous_scheduling = raise_scheduling_priority((0, new_participant.native_id))
+        try:
+            timeit_result = timeit.repeat(
+                partial(getattr(new_participant, protocol.execute_method_name), *execute_args),
+                setup=barrier.wait, number=1, repeat=TIMEIT_REPETITION)
+        finally:
+            restore_scheduling_priority(previous_scheduling)
+        barrier.wait()
+
+        results = ", ".join(f"{attribute} {getattr(new_participant, attribute)}"
+                            for attribute in protocol.result_attributes)
+        print(f"{node_id} finished {protocol.name.lower()} - {results}")
+        shared_results[node_id - 1] = min(timeit_result)
+
+    except Exception:
+        barrier.abort()  # The other participants would wait for this one forever
+        raise
+
+    finally:
+        new_participant.stop()
+        new_participant.join()
+
+
+def run_task(task, common_args):
+    """
+    Runs the client instance of one participant for one point of the scale.
+    :param task: node_id, number_of_participants and barrier
+    :param common_args: arguments of create_new_client_instance that are the same for all participants and runs
+    """
+    create_new_client_instance(*task, *common_args)
+
+
+def client_worker(connection, common_args):
+    """
+    Persistent worker process of one participant. It runs one client instance per received task, so the process is
+    reused for every point of the scale. A task only holds node_id, number_of_participants and barrier, the arguments
+    shared by all runs are passed once at the start. A None stops the worker.
+    :param connection: pipe end to receive the tasks from
+    :param common_args: arguments of create_new_client_instance that are the same for all participants and runs
+    """
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        run_task(task, common_args)
+        connection.send(True)
+
+
+def wait_for_workers(connections, processes):
+    """
+    Waits until the worker processes have finished their tasks.
+    :param connections: pipe ends the worker processes answer on
+    :param processes: the worker processes, in the same order
+    :raise RuntimeError: when a worker process has exited without finishing its task
+    """
+    for connection, process in zip(connections, processes):
+        while not connection.poll(WORKER_POLL_INTERVAL):
+            for p in processes:
+                if not p.is_alive():
+                    raise RuntimeError(f"Worker process {p.name} exited with code {p.exitcode}")
+        try:
+            connection.recv()
+        except EOFError:
+            process.join()
+            raise RuntimeError(f"Worker process {process.name} exited with code {process.exitcode}") from None
+
+
+def get_scale(number_of_participants, number_of_datapoints, log_scale):
+    if log_scale:
+        return np.unique(
+            np.geomspace(start=1, stop=number_of_participants, num=number_of_datapoints, dtype=int))[1:]
+    else:
+        return np.linspace(start=2, stop=number_of_participants, num=number_of_datapoints, dtype=int)
+
+
+def run(protocol):
+    """
+    Times the protocol for a scale of participant numbers and pickles the minimal and mean latencies.
+    :param protocol: TimedProtocol to time
+    """
+    # --in-process runs all participants as threads of this process, only meant for quick performance work
+    in_process = "--in-process" in sys.argv[1:]
+    debug_protocol = False
+    debug_network = False
+
+    participants = int(input("Number of participants: "))
+    datapoints = int(input("Number of datapoints: "))
+    security = protocol.security
+    if protocol.uses_security and security is None:
+        security = int(input("Security: "))
+    answers = tuple(input(prompt) for prompt in protocol.extra_prompts)
+    if protocol.uses_security:
+        execute_args = (security, *protocol.extra_execute_args)
+    else:
+        execute_args = protocol.extra_execute_args
+
+    scale = get_scale(number_of_participants=participants, number_of_datapoints=datapoints, log_scale=False)
+    print(scale)
+
+    results_min = np.empty(len(scale), dtype=np.float64)
+    results_mean = np.empty(len(scale), dtype=np.float64)
+    process_list = []
+    if not in_process:
+        set_start_method("forkserver", force=True)
+        # The workers are forked from the server with these modules already imported
+        set_forkserver_preload(["numpy", "pickle", "timeit", "p2p_network.participant_node", "mp_time_runner"])
+        manager = Manager()
+    # Every participant writes its minimal latency into its own slot of the shared memory
+    shared_results = RawArray("d", int(max(scale)))
+
+    common_args = (debug_protocol, debug_network, shared_results, protocol, execute_args, answers)
+    workers = []
+    for participant_id in range(1, 1 if in_process else max(scale) + 1):
+        parent_connection, child_connection = Pipe()
+        # Daemon processes are terminated when the parent fails, instead of keeping it alive
+        p = Process(target=client_worker, args=(child_connection, common_args),
+                    name=f"participant-{participant_id}", daemon=True)
+        process_list.append(p)
+        workers.append(parent_connection)
+        p.start()
+        child_connection.close()  # Only the worker holds this end, so its exit is noticed by the parent
+
+    for scale_index, participant_number in enumerate(scale):
+        barrier = Barrier(participant_number) if in_process else manager.Barrier(participant_number)
+        threads = []
+        for participant_id in range(1, participant_number + 1):
+            task = (participant_id, participant_number, barrier)
+            if in_process:
+                threads.append(Thread(target=run_task, args=(task, common_args)))
+                threads[-1].start()
+            else:
+                workers[participant_id - 1].send(task)
+        for t in threads:
+            t.join()
+        try:
+            wait_for_workers(workers[:participant_number], process_list[:participant_number])
+        except RuntimeError:
+            barrier.abort()
+            raise
+        if barrier.broken:
+            raise RuntimeError(f"A participant failed with {participant_number} participants")
+
+        process_results = np.frombuffer(shared_results, dtype=np.float64, count=participant_number)
+
+        results_min[scale_index] = process_results.min()
+        results_mean[scale_index] = process_results.mean()
+
+    for worker in workers:
+        worker.send(None)
+    for p in process_list:
+        p.join()
+
+    if in_process:
+        print(f"Minimal latencies {results_min}")
+        print("Finished")
+        return
+
+    pickle_dict = {"protocol": protocol.name, "scale": scale, "results_min": results_min,
+                   "results_mean": results_mean, "datapoints": datapoints, "participants": participants}
+    if protocol.uses_security:
+        pickle_dict["security"] = security
+    LOG_DIR.mkdir(exist_ok=True)
+    with open(LOG_DIR / protocol.log_name, "wb") as f:
+        pickle.dump(pickle_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    manager.shutdown()
+    print("Finished")
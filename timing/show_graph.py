@@ -1,10 +1,22 @@
 import pickle
 import csv
+from pathlib import Path
+import numpy as np
 from matplotlib import pyplot as plt
 
+LOG_DIR = Path(__file__).parent / "timing_logs"
 
-def plot_graph(name, save=False):
-    with open(f"timing_logs/{name}_pickle.pickle", "rb") as f:
+
+def plot_graph(name, save=False, ax=None, color="green"):
+    """
+    Plots the minimal latencies of a timing log. Without given axes, a new figure is created and shown.
+    :param name: name of the timing log, e.g. "parity" for timing_logs/parity_pickle.pickle
+    :param save: append the minimal latencies to timing_logs/saves/{name}_save.csv
+    :param ax: matplotlib axes to plot into, the figure is not shown then
+    :param color: color of the line, None uses the next color of the axes
+    :return: axes the graph was plotted into
+    """
+    with open(LOG_DIR / f"{name}_pickle.pickle", "rb") as f:
         num_dict = pickle.load(f)
 
     x_values = num_dict.get("scale")
@@ -12,19 +24,38 @@ def plot_graph(name, save=False):
     y_values_mean = num_dict.get("results_mean")
 
     if save:
-        with open(f"timing_logs/saves/{name}_save.csv", "a", newline="") as f:
+        with open(LOG_DIR / "saves" / f"{name}_save.csv", "a", newline="") as f:
             writer = csv.writer(f, delimiter=";")
-            writer.writerow(list(x_values) + [float("{:.2f}".format(v)) for v in y_values_min])
-
-    plt.title(f"{num_dict.get('protocol')} Protocol - {num_dict.get('participants')} Participants - "
-              f"{num_dict.get('datapoints')} Datapoints")
-    plt.plot(x_values, y_values_min, color="green", label=num_dict.get('protocol'))
-    # plt.plot(x_values, y_values_mean, color="red", label="mean")
-    # plt.xscale("log")
-    plt.grid(True)
-    plt.xlabel("Number of participants")
-    plt.ylabel("Latency [s]")
-    plt.legend()
+            writer.writerow(np.asarray(x_values).tolist() + np.round(np.asarray(y_values_min), 2).tolist())
+
+    show = ax is None
+    if show:
+        _, ax = plt.subplots()
+
+    ax.set_title(f"{num_dict.get('protocol')} Protocol - {num_dict.get('participants')} Participants - "
+                 f"{num_dict.get('datapoints')} Datapoints")
+    ax.plot(x_values, y_values_min, color=color, label=num_dict.get('protocol'))
+    # ax.plot(x_values, y_values_mean, color="red", label="mean")
+    # ax.set_xscale("log")
+    ax.grid(True)
+    ax.set_xlabel("Number of participants")
+    ax.set_ylabel("Latency [s]")
+    ax.legend()
+    if show:
+        plt.show()
+    return ax
+
+
+def plot_graphs(names, save=False):
+    """
+    Plots the minimal latencies of several timing logs into one figure and shows it once.
+    :param names: names of the timing logs, see plot_graph
+    :param save: append the minimal latencies of every timing log to its csv file
+    """
+    _, ax = plt.subplots()
+    for name in names:
+        plot_graph(name, save=save, ax=ax, color=None)
+    ax.set_title("Protocol Latencies")
     plt.show()
 
 